@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# 无摄像头压测：用合成/文件帧源启动 camera_web，模拟 N 个 /video_feed 客户端，
+# 统计采集帧率、端到端延迟分位数、每客户端 CPU 与内存，作为性能回归基线。
+#
+#   python benchmark.py --clients 1,5,20 --duration 10 \
+#       --source 'synthetic:?width=1920&height=1080&fps=30&objects=3'
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(source, port):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'camera_web.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--source', source],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=HERE)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/status')
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def process_stats(pid):
+    # 返回 (CPU 秒数, RSS 字节)；优先读 /proc（Linux），否则尝试 psutil
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        return cpu, rss
+    except (OSError, StopIteration):
+        pass
+    try:
+        import psutil
+        p = psutil.Process(pid)
+        t = p.cpu_times()
+        return t.user + t.system, p.memory_info().rss
+    except Exception:
+        return None, None
+
+
+def scrape_metric(port, name):
+    # 带标签的序列（例如每个摄像头一条）求和
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/metrics')
+    total = 0.0
+    for line in conn.getresponse().read().decode().splitlines():
+        if line.startswith(name + ' ') or line.startswith(name + '{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+class StreamClient(threading.Thread):
+    """一个 /video_feed 客户端：按 Content-Length 解析 multipart，记录每帧端到端延迟。"""
+
+    def __init__(self, port, query, stop):
+        super().__init__(daemon=True)
+        self.port = port
+        self.query = query
+        self.stop = stop
+        self.measuring = False
+        self.frames = 0
+        self.latencies = []
+        self.error = None
+
+    def run(self):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            conn.request('GET', '/video_feed' + self.query)
+            resp = conn.getresponse()
+            while not self.stop.is_set():
+                length, ts = 0, None
+                line = resp.fp.readline()
+                if not line:
+                    break
+                if not line.startswith(b'--frame'):
+                    continue
+                while True:
+                    line = resp.fp.readline().strip()
+                    if not line:
+                        break
+                    key, _, value = line.partition(b':')
+                    if key.lower() == b'content-length':
+                        length = int(value)
+                    elif key.lower() == b'x-timestamp':
+                        ts = float(value)
+                resp.fp.read(length)
+                if self.measuring:
+                    self.frames += 1
+                    if ts is not None:
+                        self.latencies.append(time.time() - ts)
+            conn.close()
+        except Exception as e:
+            self.error = e
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def run_case(port, pid, clients, duration, warmup, query):
+    stop = threading.Event()
+    workers = [StreamClient(port, query, stop) for _ in range(clients)]
+    for w in workers:
+        w.start()
+    time.sleep(warmup)
+
+    captured0 = scrape_metric(port, 'camera_frames_captured_total')
+    cpu0, _ = process_stats(pid)
+    for w in workers:
+        w.measuring = True
+    start = time.time()
+    time.sleep(duration)
+    for w in workers:
+        w.measuring = False
+    elapsed = time.time() - start
+    cpu1, rss = process_stats(pid)
+    captured1 = scrape_metric(port, 'camera_frames_captured_total')
+    stop.set()
+
+    latencies = [v for w in workers for v in w.latencies]
+    cpu_pct = None if cpu0 is None else (cpu1 - cpu0) / elapsed * 100.0
+    result = {
+        'clients': clients,
+        'capture_fps': round((captured1 - captured0) / elapsed, 2),
+        'delivered_fps_per_client': round(sum(w.frames for w in workers) / elapsed / clients, 2),
+        'latency_ms_p50': round(percentile(latencies, 50) * 1000, 2),
+        'latency_ms_p90': round(percentile(latencies, 90) * 1000, 2),
+        'latency_ms_p99': round(percentile(latencies, 99) * 1000, 2),
+        'server_cpu_pct': None if cpu_pct is None else round(cpu_pct, 1),
+        'cpu_pct_per_client': None if cpu_pct is None else round(cpu_pct / clients, 2),
+        'server_rss_mb': None if rss is None else round(rss / 1024.0 / 1024.0, 1),
+        'errors': [repr(w.error) for w in workers if w.error],
+    }
+    for w in workers:
+        w.join(timeout=2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless camera_web benchmark')
+    parser.add_argument('--source', default='synthetic:?width=1280&height=720&fps=30&objects=3',
+                        help='frame source spec passed to camera_web --source')
+    parser.add_argument('--clients', default='1,5,20', help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds measured per case')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds before measuring each case')
+    parser.add_argument('--query', default='', help="extra /video_feed query, e.g. '?width=640&fps=10'")
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    port = free_port()
+    proc = start_server(args.source, port)
+    results = []
+    try:
+        for n in (int(v) for v in args.clients.split(',') if v.strip()):
+            r = run_case(port, proc.pid, n, args.duration, args.warmup, args.query)
+            results.append(r)
+            print(json.dumps(r, ensure_ascii=False))
+            sys.stdout.flush()
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'source': args.source, 'query': args.query, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,39 +2,1134 @@
 # source ~/cam_env/bin/activate
 
 import cv2
+import numpy as np
 import threading
 import time
+import io
 import os
+import socket
+import sqlite3
+import sys
+import asyncio
+import signal
+import json
+import bisect
+import itertools
+import queue
+import shutil
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, Response, render_template_string, jsonify, request
+from multiprocessing import shared_memory
+from urllib.parse import parse_qsl
+from flask import Flask, Response, abort, jsonify, make_response, render_template_string, request
+
+
+# ======================
+# 指标（Prometheus 文本格式）
+# ======================
+class Metrics:
+    """轻量指标注册表：计数器、仪表、直方图以及抓取时计算的回调指标。
+
+    热路径上只有一次加锁和一次二分查找，可常驻生产环境；/metrics 以
+    Prometheus 文本格式输出。
+    """
+
+    # 直方图桶（秒），覆盖亚毫秒级编码到秒级磁盘停顿
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._hists = {}
+        self._callbacks = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def callback(self, name, kind, help_text, fn):
+        # fn() 返回数值，或 [(labels_dict, value), ...]，在抓取时调用
+        self._meta[name] = (kind, help_text)
+        self._callbacks[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def remove(self, name, **labels):
+        # 删除某个带标签的序列（例如已断开的客户端）
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values.pop(key, None)
+            self._hists.pop(key, None)
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            hists = {k: (list(v[0]), v[1], v[2]) for k, v in self._hists.items()}
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if name in self._callbacks:
+                try:
+                    result = self._callbacks[name]()
+                except Exception:
+                    continue
+                if not isinstance(result, list):
+                    result = [({}, result)]
+                for labels, value in result:
+                    lines.append(f'{name}{self._labels(sorted(labels.items()))} {value}')
+            elif kind == 'histogram':
+                for (hname, labels), (counts, total, count) in hists.items():
+                    if hname != name:
+                        continue
+                    cumulative = 0
+                    for bound, c in zip(self.BUCKETS, counts):
+                        cumulative += c
+                        lines.append(f'{name}_bucket{self._labels(labels, ("le", bound))} {cumulative}')
+                    lines.append(f'{name}_bucket{self._labels(labels, ("le", "+Inf"))} {count}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                    lines.append(f'{name}_count{self._labels(labels)} {count}')
+            else:
+                for (vname, labels), value in values.items():
+                    if vname == name:
+                        lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('camera_stage_seconds', 'histogram',
+                 'Per-stage latency of the capture->detect->encode->send pipeline')
+metrics.describe('camera_lock_wait_seconds', 'histogram', 'Time spent waiting to acquire frame bus locks')
+metrics.describe('camera_capture_fps', 'gauge', 'Frames per second delivered by the camera')
+metrics.describe('camera_reopen_total', 'counter', 'Number of times the camera device was reopened')
+metrics.inc('camera_reopen_total', 0)
+metrics.describe('camera_open_total', 'counter', 'Number of times the camera device was opened on demand')
+metrics.inc('camera_open_total', 0)
+metrics.describe('camera_close_total', 'counter', 'Number of times the idle camera device was released')
+metrics.inc('camera_close_total', 0)
+metrics.describe('camera_first_frame_seconds', 'histogram',
+                 'Time from requesting the camera to the first captured frame')
+metrics.describe('camera_client_fps', 'gauge', 'Frames per second delivered to each /video_feed client')
+metrics.describe('camera_client_frames_total', 'counter', 'Frames sent to each /video_feed client')
+metrics.describe('camera_client_lag_seconds', 'gauge',
+                 'Capture-to-socket lag of the last frame written to each /video_feed client')
+metrics.describe('camera_client_skipped_frames_total', 'counter',
+                 'Frames skipped for each /video_feed client because a newer one was available')
+metrics.describe('camera_snapshot_requests_total', 'counter', '/snapshot.jpg responses by status code')
+metrics.describe('camera_torn_frames_total', 'counter',
+                 'Shared-memory frames discarded because the slot was overwritten while being encoded or copied')
+metrics.describe('camera_recording_frames_total', 'counter',
+                 'Frames selected for recording: written to disk, skipped as unchanged since the last '
+                 'written frame, or dropped by the full writer queue')
+metrics.describe('camera_recordings_bytes', 'gauge', 'Bytes used by recording sessions at the last retention scan')
+metrics.describe('camera_retention_reclaimed_bytes_total', 'counter',
+                 'Bytes reclaimed by retention (compaction and eviction)')
+metrics.describe('camera_retention_sessions_total', 'counter', 'Recording sessions compacted or evicted by retention')
+metrics.describe('camera_retention_seconds_total', 'counter', 'Wall time spent in retention runs')
+metrics.describe('camera_playback_streams', 'gauge', 'Open /playback streams')
+metrics.describe('camera_playback_frames_total', 'counter',
+                 'Frames sent by /playback: stored JPEG files, raw MJPEG packets, or re-encoded video frames')
+metrics.describe('camera_frame_pool_buffers', 'gauge', 'Preallocated full-frame buffers held by each camera pool')
+metrics.describe('camera_frame_pool_allocations_total', 'counter',
+                 'Full-frame buffers allocated because no pooled buffer was free')
+
+
+# ======================
+# 帧总线（发布/订阅）
+# ======================
+class FrameBus:
+    """单生产者、多消费者的最新帧总线。
+
+    每次 publish 都会分配一个单调递增的序号并记录采集时间戳；消费者阻塞等待
+    比自己上次看到的序号更新的帧，并能得知中间跳过了多少帧。发布的对象视为
+    只读，消费者如需修改（例如绘制水印）必须先拷贝。
+    """
+
+    def __init__(self, name='bus'):
+        self.name = name
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._ts = 0.0
+        self._item = None
+        self._listeners = []
+
+    def add_listener(self, fn):
+        # fn() 在每次发布后（锁外）被调用，用于把线程侧的新帧通知桥接到 asyncio
+        with self._cond:
+            self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        with self._cond:
+            try:
+                self._listeners.remove(fn)
+            except ValueError:
+                pass
+
+    def _acquire(self):
+        # 记录取锁等待时间，观察发布者与消费者之间的锁竞争
+        start = time.perf_counter()
+        self._cond.acquire()
+        metrics.observe('camera_lock_wait_seconds', time.perf_counter() - start, lock=self.name)
+
+    def publish(self, item, ts=None):
+        self._acquire()
+        try:
+            self._seq += 1
+            self._ts = time.time() if ts is None else ts
+            self._item = item
+            self._cond.notify_all()
+            seq = self._seq
+            listeners = list(self._listeners) if self._listeners else None
+        finally:
+            self._cond.release()
+        if listeners:
+            for fn in listeners:
+                fn()
+        return seq
+
+    def latest(self):
+        # 返回 (seq, ts, item)，尚无帧时 item 为 None
+        with self._cond:
+            return self._seq, self._ts, self._item
+
+    def wait(self, after_seq=0, timeout=None):
+        # 阻塞直到出现序号大于 after_seq 的帧；超时返回 None，
+        # 否则返回 (seq, ts, item, skipped)，skipped 为中间错过的帧数
+        self._acquire()
+        try:
+            if not self._cond.wait_for(lambda: self._seq > after_seq, timeout=timeout):
+                return None
+            skipped = self._seq - after_seq - 1 if after_seq > 0 else 0
+            return self._seq, self._ts, self._item, skipped
+        finally:
+            self._cond.release()
+
+
+class FramePool:
+    """预分配的整帧缓冲池，采集线程直接解码进池中缓冲，稳态下不再逐帧分配。
+
+    所有权是显式的：缓冲的存储是 bytearray，acquire() 借出时在其上新建一个数组（借出数组）。
+    numpy 折叠视图链时停在第一个不是数组的 base，因此从借出数组切出的任何视图，包括
+    发布给下游的只读视图，都以借出数组为 base；最后一个视图释放时借出数组才被回收，
+    weakref.finalize 随即把缓冲标记为空闲。不依赖 sys.getrefcount，在无 GIL 的解释器上
+    同样可靠，消费者也无需显式归还。全部缓冲都在使用中时新建一个；超过 max_buffers 的
+    不入池，用完由 GC 回收。帧尺寸变化时整池重建。
+    """
+
+    def __init__(self, max_buffers=16, name='pool'):
+        self.name = name
+        self.max_buffers = max_buffers
+        # 归还发生在释放最后一个视图的线程里，也可能由持锁期间触发的 GC 引起，用可重入锁
+        self._lock = threading.RLock()
+        self._key = None
+        self._buffers = []
+        self._idle = []
+        # 整池重建时递增：旧缓冲的归还不再入池
+        self._generation = 0
+
+    def _reset(self, key):
+        if key != self._key:
+            self._key = key
+            self._buffers = []
+            self._idle = []
+            self._generation += 1
+
+    def _lend(self, i):
+        # 在锁内调用：借出第 i 个缓冲
+        shape, dtype = self._key
+        lease = np.ndarray(shape, dtype, buffer=self._buffers[i])
+        weakref.finalize(lease, self._release, self._generation, i)
+        return lease
+
+    def _release(self, generation, i):
+        with self._lock:
+            if generation == self._generation:
+                self._idle.append(i)
+
+    def acquire(self):
+        # 借出一个空闲的可写缓冲；尚不知道帧尺寸（首帧之前）时返回 None
+        with self._lock:
+            if self._key is None:
+                return None
+            if self._idle:
+                return self._lend(self._idle.pop())
+            metrics.inc('camera_frame_pool_allocations_total', camera=self.name)
+            if len(self._buffers) >= self.max_buffers:
+                return np.empty(*self._key)
+            shape, dtype = self._key
+            self._buffers.append(bytearray(int(np.prod(shape)) * dtype.itemsize))
+            metrics.set('camera_frame_pool_buffers', len(self._buffers), camera=self.name)
+            return self._lend(len(self._buffers) - 1)
+
+    def adopt(self, frame):
+        # 帧源没有写入提供的缓冲（首帧或尺寸变化）：记下帧尺寸，之后按它借出缓冲；
+        # 这一帧是帧源自己分配的，不入池，用完由 GC 回收
+        with self._lock:
+            self._reset((frame.shape, frame.dtype))
+            metrics.inc('camera_frame_pool_allocations_total', camera=self.name)
+
+    @staticmethod
+    def readonly(frame):
+        # 发布给下游的只读视图：不拷贝像素，误写会直接抛出 ValueError；视图以借出数组为 base
+        view = frame.view()
+        view.flags.writeable = False
+        return view
+
+
+class EventHub:
+    """服务器推送事件（SSE）的订阅中心。
+
+    每个订阅者一个有界队列；订阅者消费过慢时丢弃其最旧的事件，
+    保证发布方（摄像头线程、请求线程）永不阻塞。
+    """
+
+    def __init__(self, maxsize=64):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._maxsize = maxsize
+
+    def subscribe(self, callback=None):
+        # 默认返回一个有界队列；也可以传入 callback(event, data)（例如桥接到 asyncio），
+        # 回调必须非阻塞
+        q = callback if callback is not None else queue.Queue(maxsize=self._maxsize)
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            try:
+                self._subscribers.remove(q)
+            except ValueError:
+                pass
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            if callable(q):
+                q(event, data)
+                continue
+            while True:
+                try:
+                    q.put_nowait((event, data))
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+class StreamProfile:
+    """一种码流配置的缩放+编码管线。
+
+    key 为 (width, fps, quality)，0 表示不限制/使用默认值。编码线程订阅 frame_bus，
+    按 fps 在服务器端跳帧，缩放并编码后发布到自己的 bus，订阅者共享结果。
+    """
+
+    def __init__(self, source, width=0, fps=0.0, quality=0):
+        self.key = (width, fps, quality)
+        self.width = width
+        self.fps = fps
+        self.quality = quality
+        self.bus = FrameBus('stream')
+        # 管线实例标识：与序号一起组成快照的 ETag，管线重建后旧 ETag 不会误匹配
+        self.epoch = '%x' % int(time.time() * 1000)
+        self.subscribers = 0
+        self.released_at = None
+        self._source = source
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality] if self.quality else []
+        period = 1.0 / self.fps if self.fps else 0.0
+        next_due = 0.0
+        last_seq = 0
+        while not self._stop.is_set():
+            got = self._source.wait(last_seq, timeout=0.5)
+            if got is None:
+                continue
+            last_seq, capture_ts, frame, _ = got
+            source = frame
+            if period:
+                # 服务器端限帧：未到时间的帧直接跳过，不做缩放与编码
+                if capture_ts < next_due:
+                    continue
+                # 落后太多时重新对齐，避免追帧
+                next_due = max(next_due + period, capture_ts)
+            h, w = frame.shape[:2]
+            if self.width and self.width < w:
+                start = time.perf_counter()
+                frame = cv2.resize(frame, (self.width, max(1, int(h * self.width / w))),
+                                   interpolation=cv2.INTER_AREA)
+                metrics.observe('camera_stage_seconds', time.perf_counter() - start, stage='resize')
+            start = time.perf_counter()
+            ret, jpeg = cv2.imencode('.jpg', frame, params)
+            metrics.observe('camera_stage_seconds', time.perf_counter() - start, stage='jpeg_encode')
+            if not frame_intact(source):
+                # 共享内存槽位在缩放/编码期间被覆盖：结果可能是新旧两帧的拼接，丢弃
+                metrics.inc('camera_torn_frames_total', stage='encode')
+                continue
+            if ret:
+                self.bus.publish(jpeg.tobytes(), capture_ts)
+
+
+# ======================
+# 时间水印
+# ======================
+class TimestampOverlay:
+    """预渲染的时间水印缓存。
+
+    每个文本只用 putText 光栅化一次，得到一小块 BGR 图案和 alpha 掩码；
+    之后每帧只需在左下角 ROI 上做一次向量化混合。缓存以
+    (文本, 字号, 画面尺寸) 为键，只保留最近几项（文本每秒才变化一次）。
+    """
+
+    def __init__(self, scale=0.6, thickness=2, margin=10, max_entries=4):
+        self.scale = scale
+        self.thickness = thickness
+        self.margin = margin
+        self.max_entries = max_entries
+        self._font = cv2.FONT_HERSHEY_SIMPLEX
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _render(self, text):
+        # 黑色描边 + 白色文字，alpha 取描边范围（含抗锯齿边缘）
+        outline = self.thickness + 2
+        (tw, th), baseline = cv2.getTextSize(text, self._font, self.scale, outline)
+        pad = outline
+        ph, pw = th + baseline + 2 * pad, tw + 2 * pad
+        origin = (pad, pad + th)
+        patch = np.zeros((ph, pw, 3), dtype=np.uint8)
+        alpha = np.zeros((ph, pw), dtype=np.uint8)
+        cv2.putText(alpha, text, origin, self._font, self.scale, 255, outline, cv2.LINE_AA)
+        cv2.putText(patch, text, origin, self._font, self.scale, (255, 255, 255), self.thickness, cv2.LINE_AA)
+        # 预乘 alpha（uint8），混合时只需 out = frame * (255 - a) / 255 + patch_premul
+        alpha3 = cv2.merge([alpha, alpha, alpha])
+        premul = cv2.multiply(patch, alpha3, scale=1.0 / 255)
+        return premul, 255 - alpha3, origin
+
+    def _patch(self, text, frame_size):
+        key = (text, self.scale, frame_size)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return entry
+        premul, inv_alpha, origin = self._render(text)
+        fw, fh = frame_size
+        # 文字基线位于 (margin, fh - margin)，与原先 putText 的位置一致
+        x0 = self.margin - origin[0]
+        y0 = fh - self.margin - origin[1]
+        ph, pw = inv_alpha.shape[:2]
+        # 裁剪到画面范围内
+        cx0, cy0 = max(0, x0), max(0, y0)
+        cx1, cy1 = min(fw, x0 + pw), min(fh, y0 + ph)
+        if cx1 <= cx0 or cy1 <= cy0:
+            entry = None
+        else:
+            sx, sy = cx0 - x0, cy0 - y0
+            entry = (
+                (cy0, cy1, cx0, cx1),
+                np.ascontiguousarray(premul[sy:sy + cy1 - cy0, sx:sx + cx1 - cx0]),
+                np.ascontiguousarray(inv_alpha[sy:sy + cy1 - cy0, sx:sx + cx1 - cx0]),
+            )
+        with self._lock:
+            self._cache[key] = entry
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return entry
+
+    def stamp(self, frame, ts=None):
+        # 在 frame 左下角原地混合时间水印
+        text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+        fh, fw = frame.shape[:2]
+        entry = self._patch(text, (fw, fh))
+        if entry is None:
+            return frame
+        (y0, y1, x0, x1), premul, inv_alpha = entry
+        roi = frame[y0:y1, x0:x1]
+        # 两次饱和 uint8 运算完成混合，结果直接写回 ROI
+        cv2.add(cv2.multiply(roi, inv_alpha, scale=1.0 / 255), premul, dst=roi)
+        return frame
+
+
+# ======================
+# 帧源
+# ======================
+class FrameSource:
+    """帧源基类，接口与 cv2.VideoCapture 的 isOpened/read/release 一致。"""
+
+    def __init__(self, fps=0.0):
+        self.fps = fps
+        self._next_due = 0.0
+
+    def _pace(self):
+        # 按 fps 节奏出帧（fps 为 0 时尽快出帧）；落后时重新对齐，不追帧
+        if not self.fps:
+            return
+        now = time.monotonic()
+        if self._next_due > now:
+            time.sleep(self._next_due - now)
+            now = self._next_due
+        self._next_due = max(self._next_due, now) + 1.0 / self.fps
+
+    def isOpened(self):
+        return True
+
+    def read(self, image=None):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    @staticmethod
+    def _output(frame, image):
+        # 与 VideoCapture.read(image) 一致：尺寸匹配时写入调用方提供的缓冲
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+
+class DeviceSource(FrameSource):
+    """V4L2 / 系统摄像头设备（按设备号打开）。"""
+
+    def __init__(self, index=0):
+        super().__init__()
+        self.index = index
+        self._cap = cv2.VideoCapture(index)
+
+    def isOpened(self):
+        return self._cap.isOpened()
+
+    def read(self, image=None):
+        return self._cap.read(image)
+
+    def release(self):
+        self._cap.release()
+
+
+class FileSource(FrameSource):
+    """视频文件或图片目录，可循环播放，可按原始帧率实时出帧（用于回放事件、压测）。"""
+
+    IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, path, loop=True, realtime=True, fps=0.0):
+        super().__init__()
+        self.path = path
+        self.loop = loop
+        self._images = None
+        self._cap = None
+        self._pos = 0
+        if os.path.isdir(path):
+            self._images = sorted(os.path.join(path, n) for n in os.listdir(path)
+                                  if n.lower().endswith(self.IMAGE_EXTS))
+            native_fps = fps or 10.0
+        else:
+            self._cap = cv2.VideoCapture(path)
+            native_fps = fps or self._cap.get(cv2.CAP_PROP_FPS) or 25.0
+        self.fps = native_fps if realtime else 0.0
+
+    def isOpened(self):
+        if self._images is not None:
+            return bool(self._images)
+        return self._cap is not None and self._cap.isOpened()
+
+    def read(self, image=None):
+        self._pace()
+        if self._images is not None:
+            if self._pos >= len(self._images):
+                if not self.loop:
+                    return False, None
+                self._pos = 0
+            frame = cv2.imread(self._images[self._pos])
+            self._pos += 1
+            if frame is None:
+                return False, None
+            return self._output(frame, image)
+        # 视频直接解码进调用方的缓冲（尺寸不符时 OpenCV 会另行分配）
+        ret, frame = self._cap.read(image)
+        if not ret and self.loop:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._cap.read(image)
+        if not ret:
+            return False, None
+        return True, frame
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+
+
+class SyntheticSource(FrameSource):
+    """合成画面：静态渐变背景上有若干匀速运动、碰边反弹的物体，用于无摄像头压测。"""
+
+    def __init__(self, width=1280, height=720, fps=30.0, objects=3, noise=0, seed=0):
+        super().__init__(fps)
+        self.width = width
+        self.height = height
+        self.noise = noise
+        rng = np.random.default_rng(seed)
+        ramp = np.linspace(40, 120, width, dtype=np.float32)
+        self._background = np.repeat(np.tile(ramp, (height, 1))[:, :, None], 3, axis=2).astype(np.uint8)
+        self._rng = rng
+        self._objects = []
+        for _ in range(objects):
+            size = int(rng.integers(max(8, height // 20), max(9, height // 6)))
+            self._objects.append([
+                float(rng.integers(0, max(1, width - size))), float(rng.integers(0, max(1, height - size))),
+                float(rng.uniform(-8, 8)) or 4.0, float(rng.uniform(-6, 6)) or 3.0,
+                size, tuple(int(c) for c in rng.integers(0, 256, 3)),
+            ])
+
+    def read(self, image=None):
+        self._pace()
+        if image is not None and image.shape == self._background.shape:
+            frame = image
+            np.copyto(frame, self._background)
+        else:
+            frame = self._background.copy()
+        if self.noise:
+            noise = self._rng.integers(0, self.noise, frame.shape, dtype=np.uint8)
+            cv2.add(frame, noise, dst=frame)
+        for obj in self._objects:
+            x, y, vx, vy, size, color = obj
+            x, y = x + vx, y + vy
+            if x < 0 or x + size > self.width:
+                vx = -vx
+                x = min(max(x, 0), self.width - size)
+            if y < 0 or y + size > self.height:
+                vy = -vy
+                y = min(max(y, 0), self.height - size)
+            obj[:4] = [x, y, vx, vy]
+            cv2.rectangle(frame, (int(x), int(y)), (int(x) + size, int(y) + size), color, -1)
+        return True, frame
+
+
+def open_frame_source(spec):
+    """按描述串打开帧源。
+
+    '0' / 'device:0'                         摄像头设备号
+    'file:/path/video.mp4?loop=1&realtime=1' 视频文件或图片目录（目录可加 fps=10）
+    'synthetic:?width=1280&height=720&fps=30&objects=3&noise=0'  合成画面
+    其它字符串按文件/目录路径处理。
+    """
+    spec = str(spec)
+    kind, _, rest = spec.partition(':')
+    if kind not in ('device', 'file', 'synthetic'):
+        kind, rest = ('device', spec) if spec.isdigit() else ('file', spec)
+    path, _, query = rest.partition('?')
+    opts = dict(parse_qsl(query))
+    if kind == 'device':
+        return DeviceSource(int(path or 0))
+    if kind == 'file':
+        return FileSource(path, loop=opts.get('loop', '1') != '0',
+                          realtime=opts.get('realtime', '1') != '0',
+                          fps=float(opts.get('fps', 0)))
+    return SyntheticSource(width=int(opts.get('width', 1280)), height=int(opts.get('height', 720)),
+                           fps=float(opts.get('fps', 30)), objects=int(opts.get('objects', 3)),
+                           noise=int(opts.get('noise', 0)), seed=int(opts.get('seed', 0)))
+
+
+# ======================
+# 共享内存帧环（采集进程 -> 多个 Web 工作进程）
+# ======================
+class SlotView(np.ndarray):
+    """共享内存槽位的只读视图，记住来源帧环与序号，用完后可检查是否已被覆盖。"""
+
+    ring = None
+    seq = 0
+
+
+def frame_intact(frame):
+    # 共享内存槽位的视图在使用期间可能被采集进程覆盖；其它帧发布后不再修改，总是完整的
+    ring = getattr(frame, 'ring', None)
+    return ring is None or ring.is_valid(frame.seq)
+
+
+class SharedFrameRing:
+    """基于 multiprocessing.shared_memory 的跨进程帧环。
+
+    布局：int64 头部 [magic, slots, height, width, latest_seq, motion, writer_pid, 保留]，
+    每个槽位的 seq(int64) 与采集时间(float64)，之后是 slots 个 HxWx3 的帧。
+    单写者按 seqlock 方式写入：先把槽位 seq 置为 -1，写完帧数据再写回新 seq，
+    最后更新 latest_seq。读者直接拿槽位的只读视图（SlotView），零拷贝；槽位在
+    slots 帧之后才会被覆盖，读者编码或拷贝完成后用 frame_intact 确认使用期间
+    未被覆盖，否则丢弃结果。
+    """
+
+    MAGIC = 0x43414D57
+    HEADER = 8
+
+    def __init__(self, shm, owner=False):
+        self._shm = shm
+        self._owner = owner
+        buf = shm.buf
+        self._header = np.ndarray((self.HEADER,), dtype=np.int64, buffer=buf)
+        if self._header[0] != self.MAGIC:
+            raise ValueError('shared memory is not a camera frame ring')
+        slots, h, w = (int(v) for v in self._header[1:4])
+        offset = self.HEADER * 8
+        self._slot_seq = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += slots * 8
+        self._slot_ts = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=offset)
+        offset += slots * 8
+        self._frames = np.ndarray((slots, h, w, 3), dtype=np.uint8, buffer=buf, offset=offset)
+        self.slots = slots
+        self.shape = (h, w, 3)
+
+    @classmethod
+    def create(cls, name, shape, slots=8):
+        h, w = shape[:2]
+        size = cls.HEADER * 8 + slots * 16 + slots * h * w * 3
+        try:
+            # 上次异常退出残留的同名段先清理掉
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((cls.HEADER,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [cls.MAGIC, slots, h, w, 0, 0, os.getpid(), 0]
+        np.ndarray((slots,), dtype=np.int64, buffer=shm.buf, offset=cls.HEADER * 8)[:] = 0
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 没有 track 参数：取消资源跟踪，避免读者退出时删除共享段
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+        return cls(shm)
+
+    def write(self, frame, ts, motion=False):
+        if frame.shape != self.shape:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+        seq = int(self._header[4]) + 1
+        slot = seq % self.slots
+        self._slot_seq[slot] = -1
+        np.copyto(self._frames[slot], frame)
+        self._slot_ts[slot] = ts
+        self._slot_seq[slot] = seq
+        self._header[5] = 1 if motion else 0
+        self._header[4] = seq
+        return seq
+
+    def latest_seq(self):
+        return int(self._header[4])
+
+    def motion(self):
+        return bool(self._header[5])
+
+    def read(self, seq=None):
+        # 返回 (seq, ts, 只读视图, motion)；槽位正在写入或已被覆盖时返回 None
+        if seq is None:
+            seq = self.latest_seq()
+        if seq <= 0:
+            return None
+        slot = seq % self.slots
+        if self._slot_seq[slot] != seq:
+            return None
+        ts = float(self._slot_ts[slot])
+        view = self._frames[slot].view(SlotView)
+        view.flags.writeable = False
+        view.ring = self
+        view.seq = seq
+        if self._slot_seq[slot] != seq:
+            return None
+        return seq, ts, view, self.motion()
+
+    def is_valid(self, seq):
+        # 帧环已关闭（读者重连）时槽位不再可信
+        slot_seq = self._slot_seq
+        return slot_seq is not None and int(slot_seq[seq % self.slots]) == seq
+
+    def close(self):
+        # 先释放所有 numpy 视图，否则 SharedMemory.close 会因缓冲仍被引用而失败
+        self._header = self._slot_seq = self._slot_ts = self._frames = None
+        try:
+            self._shm.close()
+        except Exception:
+            pass
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except Exception:
+                pass
+
+
+# ======================
+# 运动检测引擎
+# ======================
+class MotionDetector:
+    """降分辨率 + ROI 限定的运动检测，背景模型为加权滑动平均。
+
+    detect_width：检测时缩放到的宽度（像素），0 表示使用原始分辨率；
+    diff_threshold：与背景的灰度差阈值；min_area：最小目标面积（按原始分辨率像素计）；
+    bg_alpha：背景更新权重，越大背景跟随越快；rois：[(x, y, w, h), ...]，
+    原始分辨率坐标，为空表示整幅画面。返回的检测框均映射回原始分辨率坐标。
+    """
+
+    def __init__(self, detect_width=320, diff_threshold=20, min_area=50, bg_alpha=0.1, rois=None):
+        self._lock = threading.Lock()
+        self.detect_width = detect_width
+        self.diff_threshold = diff_threshold
+        self.min_area = min_area
+        self.bg_alpha = bg_alpha
+        self.rois = list(rois or [])
+        self._background = None
+        self._geometry = None
+        self._mask = None
+
+    def config(self):
+        with self._lock:
+            return {
+                'detect_width': self.detect_width,
+                'diff_threshold': self.diff_threshold,
+                'min_area': self.min_area,
+                'bg_alpha': self.bg_alpha,
+                'rois': [list(r) for r in self.rois],
+            }
+
+    def configure(self, **kwargs):
+        with self._lock:
+            for key, value in kwargs.items():
+                if value is not None:
+                    setattr(self, key, value)
+            # 分辨率或 ROI 变化后背景模型失效，下一帧重新建立
+            if 'detect_width' in kwargs or 'rois' in kwargs:
+                self._background = None
+                self._geometry = None
+
+    def reset(self):
+        with self._lock:
+            self._background = None
+            self._geometry = None
+
+    def _prepare(self, fw, fh):
+        # 计算缩放比例、ROI 外接区域（检测坐标系）以及区域内的掩码
+        if self.detect_width and fw > self.detect_width:
+            scale = self.detect_width / float(fw)
+        else:
+            scale = 1.0
+        if self.rois:
+            boxes = []
+            for (x, y, w, h) in self.rois:
+                x0, y0 = max(0, int(x)), max(0, int(y))
+                x1, y1 = min(fw, int(x + w)), min(fh, int(y + h))
+                if x1 > x0 and y1 > y0:
+                    boxes.append((x0, y0, x1, y1))
+        else:
+            boxes = []
+        if boxes:
+            ux0, uy0 = min(b[0] for b in boxes), min(b[1] for b in boxes)
+            ux1, uy1 = max(b[2] for b in boxes), max(b[3] for b in boxes)
+        else:
+            ux0, uy0, ux1, uy1 = 0, 0, fw, fh
+        crop = (ux0, uy0, ux1, uy1)
+        cw = max(1, int(round((ux1 - ux0) * scale)))
+        ch = max(1, int(round((uy1 - uy0) * scale)))
+        mask = None
+        if len(boxes) > 1 or (boxes and boxes[0] != crop):
+            mask = np.zeros((ch, cw), dtype=np.uint8)
+            for (x0, y0, x1, y1) in boxes:
+                mx0, my0 = int((x0 - ux0) * scale), int((y0 - uy0) * scale)
+                mx1, my1 = int(np.ceil((x1 - ux0) * scale)), int(np.ceil((y1 - uy0) * scale))
+                mask[my0:my1, mx0:mx1] = 255
+        self._geometry = (fw, fh, scale, crop, (cw, ch))
+        self._mask = mask
+        self._background = None
+
+    def detect(self, frame):
+        fh, fw = frame.shape[:2]
+        with self._lock:
+            if self._geometry is None or self._geometry[:2] != (fw, fh):
+                self._prepare(fw, fh)
+            _, _, scale, (ux0, uy0, ux1, uy1), (cw, ch) = self._geometry
+            mask = self._mask
+            diff_threshold = self.diff_threshold
+            min_area = self.min_area * scale * scale
+            alpha = self.bg_alpha
+
+            # 先裁剪到 ROI 外接区域（视图，无拷贝），再缩放、灰度化，避免在全分辨率上计算
+            start = time.perf_counter()
+            region = frame[uy0:uy1, ux0:ux1]
+            if scale < 1.0:
+                region = cv2.resize(region, (cw, ch), interpolation=cv2.INTER_AREA)
+            gray = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+            ksize = max(3, int(21 * scale) | 1)
+            gray = cv2.GaussianBlur(gray, (ksize, ksize), 0)
+            metrics.observe('camera_stage_seconds', time.perf_counter() - start, stage='gray_blur')
+            start = time.perf_counter()
+
+            if self._background is None:
+                self._background = gray.astype(np.float32)
+                return []
+
+            frame_delta = cv2.absdiff(gray, cv2.convertScaleAbs(self._background))
+            # 增量更新背景模型：慢速移动的目标也能与背景形成差异
+            cv2.accumulateWeighted(gray, self._background, alpha)
+
+        thresh = cv2.threshold(frame_delta, diff_threshold, 255, cv2.THRESH_BINARY)[1]
+        if mask is not None:
+            thresh = cv2.bitwise_and(thresh, mask)
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        boxes = []
+        for c in contours:
+            if cv2.contourArea(c) < min_area:
+                continue
+            (x, y, w, h) = cv2.boundingRect(c)
+            # 映射回原始分辨率坐标
+            boxes.append((
+                int(x / scale) + ux0,
+                int(y / scale) + uy0,
+                int(np.ceil(w / scale)),
+                int(np.ceil(h / scale)),
+            ))
+        metrics.observe('camera_stage_seconds', time.perf_counter() - start, stage='diff_contours')
+        return boxes
 
 # ======================
 # 全局变量
 # ======================
-# 延迟在首次访问时打开摄像头
-camera = None
-output_frame = None
-lock = threading.Lock()
-
-motion_detected = False
-
-# 摄像头线程启动标志与锁，防止并发多次启动
-camera_thread_started = False
-camera_thread_lock = threading.Lock()
-
-# 活跃客户端计数（连接到 /video_feed 的流媒体客户端数量）
-active_clients = 0
-active_clients_lock = threading.Lock()
-
-# 录制相关
-recording_active = False
-recording_dir = None
-recording_lock = threading.Lock()
-recording_thread_started = False
-recording_thread_lock = threading.Lock()
-recording_event = threading.Event()
+# 共享内存帧环名称：设置后本进程作为 Web 工作进程，只从独立的采集进程读取默认摄像头的帧，
+# 不再自己打开摄像头，可在预派生（pre-fork）服务器下运行多个工作进程。
+# 这种部署只用于观看：默认摄像头的录制与检测参数不能在工作进程中控制（见 get_controllable_camera）
+shm_name = os.environ.get('CAMERA_SHM') or None
+shm_slots = 8
+# 所有需要绘制时间水印的地方共享同一个预渲染缓存
+timestamp_overlay = TimestampOverlay()
+
+# 以下为新建摄像头的默认参数，运行中可按摄像头单独调整
+# 最后一个使用者离开后摄像头继续保持打开的宽限期（秒）：刷新页面等短暂断开无需重新打开设备；
+# 0 表示立即释放
+camera_idle_grace = float(os.environ.get('CAMERA_IDLE_GRACE', 30))
+# 宽限期内的保活采集帧率，降低空闲时的 CPU 占用（0 表示保持全速采集）
+camera_keepalive_fps = 2.0
 # 录制间隔（秒），默认10秒
 recording_interval = 10.0
+# 录制模式：'jpeg' 每帧一个文件；'video' 追加写入按时长轮转的视频分段
+recording_mode = 'jpeg'
+# 视频分段时长（秒）与容器格式（'avi' 为 MJPEG，'mp4' 为 mp4v）
+recording_segment_seconds = 300.0
+recording_video_format = 'avi'
+# 录制触发方式：'manual' 由 /start_recording 控制；'motion' 由运动信号自动开始/结束
+recording_trigger = 'manual'
+# 运动触发录制的预录（运动前）与延录（运动结束后）时长（秒）
+pre_roll_seconds = 5.0
+post_roll_seconds = 10.0
+# 预录缓冲保存已编码的 JPEG 字节，总大小上限（字节）
+pre_roll_max_bytes = 32 * 1024 * 1024
+# 录制去重：与上次写入帧相比变化像素不足该百分比的帧跳过（0 表示关闭，每次都写入）；
+# 静止画面至少每 recording_heartbeat 秒写入一帧
+recording_change_threshold = 0.0
+recording_heartbeat = 60.0
+
+# 每路摄像头预分配整帧缓冲的上限：采集总线上的最新帧、正在分析/编码/排队写盘的帧都会占用缓冲
+frame_pool_buffers = 16
+
+# 运动检测线程池：所有摄像头的分析任务共用，线程数与 CPU 核数一致。
+# OpenCV 的图像运算会释放 GIL，多个摄像头的检测可以在多个核上并行
+analysis_workers = os.cpu_count() or 4
+analysis_pool = ThreadPoolExecutor(max_workers=analysis_workers, thread_name_prefix='analysis')
+
+# 客户端编号，用作 /metrics 中每个客户端序列的标签
+client_ids = itertools.count(1)
+# 正在连接的流客户端统计（见 /clients）
+stream_clients = {}
+stream_clients_lock = threading.Lock()
+# 流连接的套接字发送缓冲上限（字节），0 表示使用系统默认
+stream_send_buffer_bytes = 256 * 1024
+# 最后一个订阅者离开后编码管线继续保留的秒数，轮询 /snapshot.jpg 的客户端可直接复用已编码的帧
+stream_profile_linger = 5.0
+
+# 录制根目录：每次录制一个以开始时间命名的子目录，目录索引数据库也放在这里
+recordings_root = os.path.join(os.getcwd(), 'recordings')
+# 录制目录索引（SQLite），首次使用时创建
+recording_catalog = None
+recording_catalog_lock = threading.Lock()
+# 写盘工作池（所有摄像头共用）：线程数、有界队列长度与队列满时的策略（drop_oldest/drop_newest/block）
+recording_writer_workers = 2
+recording_queue_size = 32
+recording_queue_policy = 'drop_oldest'
+recording_writer = None
+recording_writer_lock = threading.Lock()
+# 录制保留策略（0 表示不限制/不启用）：录制目录总占用上限（字节）与最长保留时间（秒）；
+# 结束超过 retention_compact_after 秒的会话压缩成延时视频（每 retention_timelapse_step 秒取一帧），
+# 后台清理的读写限速为 retention_io_rate 字节/秒
+retention_max_bytes = 0
+retention_max_age = 0.0
+retention_compact_after = 0.0
+retention_timelapse_step = 10.0
+retention_timelapse_fps = 10.0
+retention_io_rate = 8 * 1024 * 1024
+retention_manager = None
+# 回放时两帧之间的最长等待（秒）：去重或运动触发录制留下的长间隔不按原速空等
+playback_max_gap = 2.0
+
+
+class Camera:
+    """一路摄像头及其全部状态：帧源、采集总线、输出帧总线、运动检测、事件推送、
+    码流配置、流客户端计数与录制状态。
+
+    每路摄像头有自己的采集线程和录制线程；运动检测以任务形式提交到共享的
+    analysis_pool。帧源在首次使用时打开，空闲宽限期满后释放。
+    """
+
+    def __init__(self, cam_id, source):
+        self.id = cam_id
+        # 帧源描述串（见 open_frame_source）
+        self.source = source
+        # 已打开的帧源，延迟到首次使用时由采集线程打开
+        self.device = None
+        # 采集线程尽快写入的原始帧总线（由设备节奏驱动），只保留最新一帧；分析阶段总是取最新帧，
+        # wait 返回的 skipped 即为未分析而丢弃的帧数。其中的帧归分析阶段独占，分析时直接在其上绘制标注
+        self.capture_ring = FrameBus('capture_ring')
+        # 采集帧的预分配缓冲池，帧源直接解码进池中缓冲
+        self.frame_pool = FramePool(frame_pool_buffers, name=cam_id)
+        # 分析阶段发布的带标注原始帧（BGR），码流配置与录制从这里取帧
+        self.frame_bus = FrameBus('frame_bus')
+        # 运动/录制状态变化通过 /events 实时推送给页面
+        self.event_hub = EventHub()
+        # 运动检测引擎（参数可通过 /set_motion_config 调整）
+        self.motion_detector = MotionDetector()
+        self.motion_detected = False
+        # 最近一次运动开始/结束的采集时刻，运动触发录制据此判断启停
+        self.motion_started_ts = 0.0
+        self.motion_ended_ts = 0.0
+        # 采集/分析统计：采集帧数、已分析帧数、分析阶段来不及处理而丢弃的帧数
+        self.frames_captured = 0
+        self.frames_analyzed = 0
+        self.frames_dropped = 0
+
+        # 线程启动标志与锁，防止并发多次启动；也保护空闲状态与帧源的打开/释放
+        self.lock = threading.Lock()
+        self.thread_started = False
+        self.idle_grace = camera_idle_grace
+        self.keepalive_fps = camera_keepalive_fps
+        # 进入空闲的时刻（None 表示有使用者）；宽限期满后由采集线程真正释放设备
+        self.idle_since = None
+        # 请求打开摄像头的时刻，用于统计首帧耗时（None 表示没有待处理的打开请求）
+        self.requested_at = None
+        # 有新的使用者或进入空闲时唤醒采集线程，取代固定间隔的轮询
+        self.wakeup = threading.Event()
+
+        # 分析任务调度：同一摄像头同一时刻最多一个任务在线程池中
+        self.analysis_lock = threading.Lock()
+        self.analysis_scheduled = False
+        self.analysis_seq = 0
+
+        # 活跃客户端计数（连接到 /video_feed 的流媒体客户端数量）
+        self.active_clients = 0
+        self.clients_lock = threading.Lock()
+        # 广播阶段：按码流配置（宽度、帧率、JPEG 质量）共享编码管线，
+        # 同一配置的所有客户端共享同一份 JPEG；最后一个订阅者离开（并过了保留期）时拆除
+        self.stream_profiles = {}
+        self.stream_profiles_lock = threading.Lock()
+
+        # 录制相关
+        self.recording_active = False
+        self.recording_dir = None
+        self.recording_lock = threading.Lock()
+        self.recording_thread_started = False
+        self.recording_thread_lock = threading.Lock()
+        self.recording_event = threading.Event()
+        # 录制状态或间隔变化时唤醒录制线程，避免定时轮询
+        self.recording_wakeup = threading.Event()
+        self.recording_interval = recording_interval
+        self.recording_mode = recording_mode
+        self.recording_segment_seconds = recording_segment_seconds
+        self.recording_video_format = recording_video_format
+        self.recording_trigger = recording_trigger
+        self.pre_roll_seconds = pre_roll_seconds
+        self.post_roll_seconds = post_roll_seconds
+        self.recording_change_threshold = recording_change_threshold
+        self.recording_heartbeat = recording_heartbeat
+        # 去重统计：提交写盘的帧数与因画面未变化跳过的帧数
+        self.recording_frames_written = 0
+        self.recording_frames_skipped = 0
+        # 当前会话是否由运动自动触发
+        self.recording_auto = False
+
+
+# 摄像头注册表：编号 -> Camera；不带编号的路由使用默认摄像头
+cameras = OrderedDict()
+default_camera_id = '0'
+
+
+def configure_cameras(sources):
+    # sources 为 [(编号, 帧源描述串), ...]；在启动任何线程之前调用
+    global default_camera_id
+    cameras.clear()
+    for cam_id, source in sources:
+        cameras[cam_id] = Camera(cam_id, source)
+    default_camera_id = '0' if '0' in cameras else next(iter(cameras))
+
+
+def parse_camera_specs(text):
+    # "编号=帧源;编号=帧源"，例如 "0=0;door=file:door.mp4?loop=1"；帧源里可以含 '='
+    sources = []
+    for part in text.split(';'):
+        if part.strip():
+            cam_id, sep, source = part.strip().partition('=')
+            # 编号会出现在 URL 路径和目录名中，只允许字母、数字、'-' 与 '_'
+            if not sep or not source or not cam_id.replace('-', '').replace('_', '').isalnum():
+                raise ValueError(f'invalid camera spec: {part}')
+            sources.append((cam_id, source))
+    return sources
+
+
+# 帧源描述串可通过 --source/--camera 或环境变量 CAMERA_SOURCE/CAMERA_SOURCES 指定
+configure_cameras(parse_camera_specs(os.environ['CAMERA_SOURCES']) if os.environ.get('CAMERA_SOURCES')
+                  else [('0', os.environ.get('CAMERA_SOURCE', '0'))])
 
 # ======================
 # Flask Web
@@ -46,16 +1141,16 @@ HTML_PAGE = """
 <html>
 <head>
     <meta charset="utf-8">
-    <title>Camera Monitor</title>
+    <title>Camera Monitor - {{ cam_id }}</title>
     <style>
         #videoContainer { display:inline-block; border:6px solid transparent; }
         #videoContainer.alert { border-color: red; box-shadow: 0 0 20px red; }
     </style>
     </head>
 <body>
-    <h1>Live Camera</h1>
+    <h1>Live Camera {{ cam_id }}</h1>
     <div id="videoContainer">
-        <img id="video" src="/video_feed" width="1080">
+        <img id="video" src="/video_feed/{{ cam_id }}" width="1080">
     </div>
 
     <h2>Motion Status:</h2>
@@ -66,6 +1161,14 @@ HTML_PAGE = """
     <p>
         录制间隔（秒）：<input id="rec_interval" type="number" min="0.01" max="3600" step="0.01" style="width:6rem;"> 
         <button id="setInterval">Set</button>
+        录制模式：<select id="rec_mode">
+            <option value="jpeg">JPEG</option>
+            <option value="video">Video</option>
+        </select>
+        触发：<select id="rec_trigger">
+            <option value="manual">Manual</option>
+            <option value="motion">Motion</option>
+        </select>
     </p>
     <button id="startRec" style="display:inline-block;margin-right:1rem;">Start Recording</button>
     <button id="stopRec" style="display:inline-block;">Stop Recording</button>
@@ -123,72 +1226,73 @@ HTML_PAGE = """
         }
 
         let alerting = false;
-        setInterval(function () {
-            fetch('/status')
-                .then(response => response.json())
-                .then(data => {
-                    const text = data.motion ? "Someone has entered." : "Normal";
-                    document.getElementById('status').innerText = text;
-                    const container = document.getElementById('videoContainer');
-                    if (data.motion) {
-                        if (!alerting) {
-                            alerting = true;
-                            container.classList.add('alert');
-                            playBeep();
-                            // keep alert for 5s
-                            setTimeout(() => {
-                                container.classList.remove('alert');
-                                alerting = false;
-                            }, 5000);
-                        }
-                            // keep alert for 5s
-                            setTimeout(() => {
-                                container.classList.remove('alert');
-                                alerting = false;
-                            }, 5000);
-                    } else {
-                        container.classList.remove('alert');
-                        alerting = false;
-                    }
-                }).catch(()=>{});
-        }, 800);
+        let motionActive = false;
+        function startAlert() {
+            const container = document.getElementById('videoContainer');
+            alerting = true;
+            container.classList.add('alert');
+            playBeep();
+            // keep alert for 5s; re-alert if motion is still ongoing
+            setTimeout(() => {
+                container.classList.remove('alert');
+                alerting = false;
+                if (motionActive) startAlert();
+            }, 5000);
+        }
+        function applyMotion(data) {
+            motionActive = !!data.motion;
+            const text = data.motion ? "Someone has entered." : "Normal";
+            document.getElementById('status').innerText = text;
+            const container = document.getElementById('videoContainer');
+            if (data.motion) {
+                if (!alerting) startAlert();
+            } else {
+                container.classList.remove('alert');
+                alerting = false;
+            }
+        }
 
-        // Recording controls: register once and poll status periodically
+        // Recording controls: register once, status is pushed via /events
         (function(){
             const startBtn = document.getElementById('startRec');
             const stopBtn = document.getElementById('stopRec');
             const recIntervalInput = document.getElementById('rec_interval');
+            const recModeSelect = document.getElementById('rec_mode');
+            const recTriggerSelect = document.getElementById('rec_trigger');
             let recEditing = false;
 
             recIntervalInput.addEventListener('focus', () => { recEditing = true; });
             recIntervalInput.addEventListener('blur', () => { recEditing = false; });
 
-            function refreshRecStatus() {
-                fetch('/recording_status')
-                    .then(r => r.json()).then(data => {
-                        document.getElementById('rec_status').innerText = data.recording ? 'Recording' : 'Stopped';
-                        document.getElementById('rec_dir').innerText = data.dir ? ('Folder: ' + data.dir) : '';
-                        // update interval input & display if provided and user is not editing
-                        if (data.interval !== undefined) {
-                            if (!recEditing) {
-                                recIntervalInput.value = data.interval;
-                            }
-                            // always update visible display so user sees current value
-                            try {
-                                const v = parseFloat(data.interval);
-                                document.getElementById('rec_interval_display').innerText = isFinite(v) ? (v + ' s') : '';
-                            } catch (e) { }
-                        }
-                        startBtn.style.display = data.recording ? 'none' : 'inline-block';
-                        stopBtn.style.display = data.recording ? 'inline-block' : 'none';
-                    }).catch(()=>{});
+            function applyRecStatus(data) {
+                document.getElementById('rec_status').innerText = data.recording ? 'Recording' : 'Stopped';
+                document.getElementById('rec_dir').innerText = data.dir ? ('Folder: ' + data.dir) : '';
+                // update interval input & display if provided and user is not editing
+                if (data.interval !== undefined) {
+                    if (!recEditing) {
+                        recIntervalInput.value = data.interval;
+                    }
+                    // always update visible display so user sees current value
+                    try {
+                        const v = parseFloat(data.interval);
+                        document.getElementById('rec_interval_display').innerText = isFinite(v) ? (v + ' s') : '';
+                    } catch (e) { }
+                }
+                if (data.mode !== undefined) {
+                    recModeSelect.value = data.mode;
+                }
+                if (data.trigger !== undefined) {
+                    recTriggerSelect.value = data.trigger;
+                }
+                startBtn.style.display = data.recording ? 'none' : 'inline-block';
+                stopBtn.style.display = data.recording ? 'inline-block' : 'none';
             }
 
             startBtn.addEventListener('click', function () {
-                fetch('/start_recording').then(r=>r.json()).then(()=>refreshRecStatus()).catch(()=>{});
+                fetch('/start_recording/{{ cam_id }}').catch(()=>{});
             });
             stopBtn.addEventListener('click', function () {
-                fetch('/stop_recording').then(r=>r.json()).then(()=>refreshRecStatus()).catch(()=>{});
+                fetch('/stop_recording/{{ cam_id }}').catch(()=>{});
             });
 
             // set interval control
@@ -196,19 +1300,31 @@ HTML_PAGE = """
             function submitInterval() {
                 const val = parseFloat(recIntervalInput.value);
                 if (!isFinite(val) || val < 0.01) return;
-                fetch('/set_recording_interval?interval=' + encodeURIComponent(val)).then(r=>r.json()).then(()=>refreshRecStatus()).catch(()=>{});
+                fetch('/set_recording_interval/{{ cam_id }}?interval=' + encodeURIComponent(val)).catch(()=>{});
                 recIntervalInput.blur();
             }
             setBtn.addEventListener('click', submitInterval);
+            recModeSelect.addEventListener('change', function () {
+                fetch('/set_recording_mode/{{ cam_id }}?mode=' + encodeURIComponent(recModeSelect.value)).catch(()=>{});
+            });
+            recTriggerSelect.addEventListener('change', function () {
+                fetch('/set_recording_trigger/{{ cam_id }}?trigger=' + encodeURIComponent(recTriggerSelect.value)).catch(()=>{});
+            });
             recIntervalInput.addEventListener('keydown', function(e) {
                 if (e.key === 'Enter') {
                     submitInterval();
                 }
             });
 
-            // initial status and periodic refresh
-            refreshRecStatus();
-            setInterval(refreshRecStatus, 1000);
+            // 状态由服务器推送（SSE）；EventSource 断线后会自动重连，
+            // 重连时服务器会先推送一次当前状态
+            const events = new EventSource('/events/{{ cam_id }}');
+            events.addEventListener('motion', e => {
+                try { applyMotion(JSON.parse(e.data)); } catch (err) { }
+            });
+            events.addEventListener('recording', e => {
+                try { applyRecStatus(JSON.parse(e.data)); } catch (err) { }
+            });
         })();
     </script>
 </body>
@@ -216,364 +1332,2849 @@ HTML_PAGE = """
 """
 
 
-@app.route('/')
-def index():
+def get_camera(cam_id=None):
+    # 路由中的摄像头编号 -> Camera；未知编号直接以 404 JSON 结束请求
+    cam = cameras.get(cam_id or default_camera_id)
+    if cam is None:
+        abort(make_response(jsonify({'success': False, 'error': f'unknown camera: {cam_id}'}), 404))
+    return cam
+
+
+SHM_CONTROL_ERROR = ('camera is read from shared memory (CAMERA_SHM): recording and motion settings '
+                     'are not available in web workers')
+
+
+def get_controllable_camera(cam_id=None):
+    # 录制控制与检测参数路由使用。共享内存模式下默认摄像头的检测在独立的采集进程中进行，
+    # 各工作进程的录制状态也互不相通，请求只会作用于碰巧接到它的那个进程，因此以 409 明确拒绝
+    cam = get_camera(cam_id)
+    if shm_name and cam.id == default_camera_id:
+        abort(make_response(jsonify({'success': False, 'error': SHM_CONTROL_ERROR}), 409))
+    return cam
+
+
+@app.route('/', defaults={'cam_id': None})
+@app.route('/camera/<cam_id>')
+def index(cam_id):
+    cam = get_camera(cam_id)
     return render_template_string(
         HTML_PAGE,
-        status="Someone has entered." if motion_detected else "normal"
+        cam_id=cam.id,
+        status="Someone has entered." if cam.motion_detected else "normal"
     )
 
-@app.route('/status')
-def status():
-    return jsonify({'motion': bool(motion_detected)})
 
+@app.route('/cameras')
+def list_cameras():
+    return jsonify({'default': default_camera_id,
+                    'cameras': [{'id': cam.id, 'source': cam.source, 'motion': bool(cam.motion_detected),
+                                 **camera_state(cam)} for cam in cameras.values()]})
 
-@app.route('/recording_status')
-def recording_status():
-    return jsonify({'recording': bool(recording_active), 'dir': recording_dir or '', 'interval': recording_interval})
 
+@app.route('/status', defaults={'cam_id': None})
+@app.route('/status/<cam_id>')
+def status(cam_id):
+    cam = get_camera(cam_id)
+    return jsonify({
+        'camera_id': cam.id,
+        'motion': bool(cam.motion_detected),
+        'frames_captured': cam.frames_captured,
+        'frames_analyzed': cam.frames_analyzed,
+        'frames_dropped': cam.frames_dropped,
+        'camera': camera_state(cam),
+    })
 
-@app.route('/start_recording')
-def start_recording():
-    global recording_active, recording_dir
-    ensure_camera_started()
 
-    # 等待首帧可用
-    waited = 0
-    while True:
-        with lock:
-            frame = None if output_frame is None else output_frame.copy()
-        if frame is not None:
-            break
-        time.sleep(0.05)
-        waited += 0.05
-        if waited > 5:
-            break
+@app.route('/clients')
+def clients():
+    # 每个流客户端的落后时长、跳帧数、写套接字耗时等
+    with stream_clients_lock:
+        meters = list(stream_clients.values())
+    return jsonify({'clients': [m.stats() for m in meters]})
 
-    # 创建新的文件夹（以当前时间为初始帧时间）
-    now = datetime.now()
-    folder_name = now.strftime('%Y%m%d_%H%M%S')
-    base_dir = os.path.join(os.getcwd(), 'recordings')
-    os.makedirs(base_dir, exist_ok=True)
-    dir_path = os.path.join(base_dir, folder_name)
-    os.makedirs(dir_path, exist_ok=True)
 
-    with recording_lock:
-        recording_dir = dir_path
-        recording_active = True
-        recording_event.set()
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-    ensure_recording_started()
-    return jsonify({'started': True, 'dir': recording_dir})
 
+def per_camera(fn):
+    # 回调指标：每个摄像头一条带 camera 标签的序列
+    return lambda: [({'camera': cam.id}, fn(cam)) for cam in list(cameras.values())]
 
-@app.route('/stop_recording')
-def stop_recording():
-    global recording_active
-    with recording_lock:
-        recording_active = False
-        recording_event.clear()
-    # 如果没有活跃的流媒体客户端，则停止录制后释放摄像头以节省资源
-    try:
-        with active_clients_lock:
-            remaining = active_clients
-        if remaining == 0:
-            try:
-                if camera is not None:
-                    camera.release()
-            except Exception:
-                pass
-            # 将 camera 置为 None，以便后续需要时可重新打开
-            try:
-                globals()['camera'] = None
-            except Exception:
-                pass
-    except Exception:
-        pass
 
-    return jsonify({'stopped': True})
+metrics.callback('camera_frames_captured_total', 'counter', 'Frames read from the camera',
+                 per_camera(lambda cam: cam.frames_captured))
+metrics.callback('camera_frames_analyzed_total', 'counter', 'Frames processed by motion detection',
+                 per_camera(lambda cam: cam.frames_analyzed))
+metrics.callback('camera_frames_dropped_total', 'counter',
+                 'Captured frames dropped because the analysis stage was busy',
+                 per_camera(lambda cam: cam.frames_dropped))
+metrics.callback('camera_motion', 'gauge', 'Whether motion is currently detected',
+                 per_camera(lambda cam: int(cam.motion_detected)))
+metrics.callback('camera_active_clients', 'gauge', 'Connected /video_feed clients',
+                 per_camera(lambda cam: cam.active_clients))
+metrics.callback('camera_open', 'gauge', 'Whether the camera device is currently open',
+                 per_camera(lambda cam: int(cam.device is not None)))
+metrics.callback('camera_idle', 'gauge', 'Whether the open camera is in its idle grace period',
+                 per_camera(lambda cam: int(cam.device is not None and cam.idle_since is not None)))
+metrics.callback('camera_stream_profiles', 'gauge', 'Distinct stream profiles being encoded',
+                 per_camera(lambda cam: len(cam.stream_profiles)))
+metrics.callback('camera_recording_queue_depth', 'gauge', 'Frames waiting in the recording writer queue',
+                 lambda: recording_writer.stats()['queue_depth'] if recording_writer else 0)
+metrics.callback('camera_recording_dropped_total', 'counter', 'Frames dropped by the recording writer queue',
+                 lambda: recording_writer.stats()['dropped'] if recording_writer else 0)
+metrics.callback('camera_recording_errors_total', 'counter', 'Failed recording writes',
+                 lambda: recording_writer.stats()['errors'] if recording_writer else 0)
 
 
-@app.route('/set_recording_interval')
-def set_recording_interval():
-    global recording_interval
-    val = request.args.get('interval', None)
-    if val is None:
-        return jsonify({'success': False, 'error': 'missing interval parameter'}), 400
+def recording_state(cam):
+    return {
+        'camera_id': cam.id,
+        'recording': bool(cam.recording_active),
+        'dir': cam.recording_dir or '',
+        'interval': cam.recording_interval,
+        'mode': cam.recording_mode,
+        'segment_seconds': cam.recording_segment_seconds,
+        'format': cam.recording_video_format,
+        'writer': recording_writer.stats() if recording_writer is not None else None,
+        'catalog': recording_catalog.stats() if recording_catalog is not None else None,
+        'retention': retention_manager.stats() if retention_manager is not None else None,
+        'trigger': cam.recording_trigger,
+        'auto': cam.recording_auto,
+        'pre_roll': cam.pre_roll_seconds,
+        'post_roll': cam.post_roll_seconds,
+        'change_threshold': cam.recording_change_threshold,
+        'heartbeat': cam.recording_heartbeat,
+        'frames_written': cam.recording_frames_written,
+        'frames_skipped': cam.recording_frames_skipped,
+    }
+
+
+@app.route('/recording_status', defaults={'cam_id': None})
+@app.route('/recording_status/<cam_id>')
+def recording_status(cam_id):
+    return jsonify(recording_state(get_camera(cam_id)))
+
+
+def parse_time_arg(value):
+    # 支持 Unix 时间戳（秒）、'YYYYmmdd_HHMMSS' 以及 ISO 8601（本地时间），空值返回 None
+    if value in (None, ''):
+        return None
+    # float() 也接受带下划线的数字，因此先按目录命名格式解析
+    for parse in (lambda v: datetime.strptime(v, '%Y%m%d_%H%M%S').timestamp(), float,
+                  lambda v: datetime.fromisoformat(v).timestamp()):
+        try:
+            return parse(value)
+        except ValueError:
+            continue
+    raise ValueError(f'invalid time: {value}')
+
+
+@app.route('/recordings')
+def recordings():
+    # 录制会话列表（新的在前）；参数：limit，before（上一页返回的 next）
     try:
-        f = float(val)
-    except Exception:
-        return jsonify({'success': False, 'error': 'invalid interval'}), 400
-    if f < 0.01:
-        return jsonify({'success': False, 'error': 'interval must be >= 0.01'}), 400
-    with recording_lock:
-        recording_interval = f
-    return jsonify({'success': True, 'interval': recording_interval})
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+        before = parse_time_arg(request.args.get('before'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'invalid limit/before'}), 400
+    sessions = get_recording_catalog().sessions(limit, before)
+    return jsonify({'sessions': sessions,
+                    'next': sessions[-1]['started'] if len(sessions) == limit else None})
 
-def generate():
-    global output_frame, active_clients, camera
 
-    # 注册为活跃客户端
-    with active_clients_lock:
-        active_clients += 1
+@app.route('/recordings/frames')
+def recording_frames():
+    # 按时间范围查询帧：start、end（时间戳/YYYYmmdd_HHMMSS/ISO）、session、motion=0|1、limit，
+    # cursor 为上一页返回的 next（"ts:id"），按时间顺序翻页
+    try:
+        start = parse_time_arg(request.args.get('start'))
+        end = parse_time_arg(request.args.get('end'))
+        limit = min(1000, max(1, int(request.args.get('limit', 100))))
+        motion = request.args.get('motion')
+        motion = None if motion in (None, '') else bool(int(motion))
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor:
+            ts, frame_id = cursor.split(':')
+            after = (float(ts), int(frame_id))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'invalid start/end/limit/motion/cursor'}), 400
+    frames = get_recording_catalog().frames(start, end, request.args.get('session') or None, motion, after, limit)
+    for f in frames:
+        f['thumbnail'] = f"/recordings/thumbnail/{f['id']}"
+    last = frames[-1] if len(frames) == limit else None
+    return jsonify({'frames': frames, 'next': f"{last['ts']!r}:{last['id']}" if last else None})
 
-    # 确保摄像头已启动（如果需要的话会启动线程并打开摄像头）
-    ensure_camera_started()
 
+@app.route('/recordings/thumbnail/<int:frame_id>')
+def recording_thumbnail(frame_id):
+    # 缩略图按帧缓存；参数 width（16..640，默认 160）
     try:
-        while True:
-            with lock:
-                frame = None if output_frame is None else output_frame.copy()
+        width = int(request.args.get('width', 160))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'invalid width'}), 400
+    if width < 16 or width > 640:
+        return jsonify({'success': False, 'error': 'width must be in 16..640'}), 400
+    data = get_recording_catalog().thumbnail(frame_id, width)
+    if data is None:
+        return jsonify({'success': False, 'error': 'frame not found'}), 404
+    # 帧编号自增且不复用（压缩或清理后的新记录也是新编号），同一编号的缩略图内容不变
+    return Response(data, mimetype='image/jpeg', headers={'Cache-Control': 'public, max-age=86400'})
 
-            if frame is None:
-                time.sleep(0.01)
-                continue
 
-            # 在发送前更新时间水印，确保浏览器端流始终显示当前时间
-            try:
-                tstamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                fh, fw = frame.shape[:2]
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                scale = 0.6
-                thickness = 2
-                x = 10
-                y = fh - 10
-                cv2.putText(frame, tstamp, (x, y), font, scale, (0, 0, 0), thickness + 2, cv2.LINE_AA)
-                cv2.putText(frame, tstamp, (x, y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
-            except Exception:
-                pass
+def parse_playback_params(args):
+    # 参数：start（起始时间，格式同 /recordings/frames）、frame（从 start 起跳过的帧数）、
+    # step（每隔几帧发送一帧）、speed（倍速，0 表示尽快发送）。
+    # 返回 ((start, skip, step, speed), None) 或 (None, 错误信息)
+    try:
+        start = parse_time_arg(args.get('start'))
+        skip = int(args.get('frame', 0))
+        step = int(args.get('step', 1))
+        speed = float(args.get('speed', 1.0))
+    except ValueError:
+        return None, 'invalid start/frame/step/speed'
+    if skip < 0 or step < 1:
+        return None, 'frame must be >= 0 and step >= 1'
+    if speed < 0 or speed > 64:
+        return None, 'speed must be in 0..64'
+    return (start, skip, step, speed), None
+
+
+def playback_has_frames(catalog, session, start=None):
+    # 目录索引刚创建时还在补录已有的会话，稍等片刻再判断会话是否存在
+    catalog.ready.wait(10)
+    return bool(catalog.frames(start, None, session, None, None, 1))
+
 
-            ret, jpeg = cv2.imencode('.jpg', frame)
-            if not ret:
-                time.sleep(0.01)
+def playback_frames(catalog, reader, session, start=None, skip=0, step=1):
+    # 按目录索引分页取帧：跳过 start 之后的前 skip 帧，之后每 step 帧产出 (采集时间, JPEG, 来源)
+    after = None
+    index = 0
+    while True:
+        rows = catalog.frames(start, None, session, None, after, 200)
+        if not rows:
+            return
+        after = (rows[-1]['ts'], rows[-1]['id'])
+        for row in rows:
+            index += 1
+            if index <= skip or (index - skip - 1) % step:
                 continue
+            jpeg, source = reader.read(row['file'], row['offset'])
+            if jpeg is not None:
+                yield row['ts'], jpeg, source
+
+
+class PlaybackPacer:
+    """回放节拍：speed 倍速按采集时间间隔出帧，单次等待不超过 playback_max_gap 秒；
+    speed 为 0 表示尽快发送。只计算等待时长，由调用方决定怎样等待。"""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self._prev_ts = None
+        self._due = time.monotonic()
 
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' +
-                   jpeg.tobytes() + b'\r\n')
+    def delay(self, ts):
+        # 返回发送采集时间为 ts 的帧之前需要等待的秒数
+        prev_ts, self._prev_ts = self._prev_ts, ts
+        if not self.speed or prev_ts is None:
+            return 0.0
+        self._due += min(playback_max_gap, max(0.0, ts - prev_ts) / self.speed)
+        delay = self._due - time.monotonic()
+        if delay <= 0:
+            # 落后时重新对齐，不追帧
+            self._due = time.monotonic()
+            return 0.0
+        return delay
+
+
+def playback_stream(catalog, session, start=None, skip=0, step=1, speed=1.0):
+    reader = PlaybackReader(os.path.join(recordings_root, session))
+    pacer = PlaybackPacer(speed)
+    metrics.inc('camera_playback_streams', 1)
+    try:
+        for ts, jpeg, source in playback_frames(catalog, reader, session, start, skip, step):
+            delay = pacer.delay(ts)
+            if delay:
+                time.sleep(delay)
+            metrics.inc('camera_playback_frames_total', source=source)
+            yield stream_part(jpeg, ts)
     except GeneratorExit:
-        # 客户端断开时会抛出 GeneratorExit，继续到 finally
         pass
     finally:
-        # 注销活跃客户端；如果没有剩余客户端则关闭摄像头释放资源
-        with active_clients_lock:
-            active_clients -= 1
-            remaining = active_clients
-        if remaining == 0:
-            # 如果当前正在录制，则不要释放摄像头（录制线程需要持续帧）
-            with recording_lock:
-                is_recording = bool(recording_active)
-
-            if not is_recording:
-                try:
-                    if camera is not None:
-                        camera.release()
-                except Exception:
-                    pass
-                try:
-                    globals()['camera'] = None
-                except Exception:
-                    pass
+        reader.close()
+        metrics.inc('camera_playback_streams', -1)
 
-@app.route('/video_feed')
-def video_feed():
-    return Response(generate(),
+
+@app.route('/playback/<session>')
+def playback(session):
+    # 以 /video_feed 相同的 multipart 格式回放一个录制会话，参数见 parse_playback_params
+    params, error = parse_playback_params(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    catalog = get_recording_catalog()
+    if not playback_has_frames(catalog, session, params[0]):
+        return jsonify({'success': False, 'error': f'no recorded frames: {session}'}), 404
+    limit_send_buffer(request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket'))
+    return Response(playback_stream(catalog, session, *params),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/events', defaults={'cam_id': None})
+@app.route('/events/<cam_id>')
+def events(cam_id):
+    # Server-Sent Events：连接时先推送当前状态，之后只在状态变化时推送
+    cam = get_camera(cam_id)
+    q = cam.event_hub.subscribe()
+
+    def stream():
+        try:
+            yield sse_message('motion', {'motion': bool(cam.motion_detected)})
+            yield sse_message('recording', recording_state(cam))
+            while True:
+                try:
+                    event, data = q.get(timeout=15)
+                except queue.Empty:
+                    # 心跳注释行，防止代理断开空闲连接
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(event, data)
+        finally:
+            cam.event_hub.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def new_recording_dir(cam, ts=None):
+    # 创建新的文件夹（以当前时间或给定的首帧时间命名）；摄像头 0 以外的目录名带摄像头编号
+    now = datetime.now() if ts is None else datetime.fromtimestamp(ts)
+    folder_name = now.strftime('%Y%m%d_%H%M%S')
+    if cam.id != '0':
+        folder_name += f'-{cam.id}'
+    os.makedirs(recordings_root, exist_ok=True)
+    dir_path = os.path.join(recordings_root, folder_name)
+    os.makedirs(dir_path, exist_ok=True)
+    return dir_path
+
+
+@app.route('/start_recording', defaults={'cam_id': None})
+@app.route('/start_recording/<cam_id>')
+def start_recording(cam_id):
+    cam = get_controllable_camera(cam_id)
+    ensure_camera_started(cam)
+
+    # 等待首帧可用（最多 5 秒）
+    cam.frame_bus.wait(0, timeout=5)
+
+    dir_path = new_recording_dir(cam)
+
+    with cam.recording_lock:
+        cam.recording_dir = dir_path
+        cam.recording_active = True
+        # 手动开始的会话（包括接管正在进行的自动会话）不受延录自动停止
+        cam.recording_auto = False
+        cam.recording_event.set()
+        cam.recording_wakeup.set()
+    cam.event_hub.publish('recording', recording_state(cam))
+
+    ensure_recording_started(cam)
+    return jsonify({'started': True, 'dir': cam.recording_dir})
+
+
+@app.route('/stop_recording', defaults={'cam_id': None})
+@app.route('/stop_recording/<cam_id>')
+def stop_recording(cam_id):
+    cam = get_controllable_camera(cam_id)
+    with cam.recording_lock:
+        cam.recording_active = False
+        cam.recording_auto = False
+        # 运动触发已布防时录制线程仍需继续维护预录缓冲
+        if cam.recording_trigger != 'motion':
+            cam.recording_event.clear()
+        cam.recording_wakeup.set()
+    cam.event_hub.publish('recording', recording_state(cam))
+    # 如果没有活跃的流媒体客户端，则停止录制后释放摄像头以节省资源
+    with cam.clients_lock:
+        remaining = cam.active_clients
+    if remaining == 0:
+        release_camera_if_idle(cam)
+
+    return jsonify({'stopped': True})
+
+
+@app.route('/set_recording_interval', defaults={'cam_id': None})
+@app.route('/set_recording_interval/<cam_id>')
+def set_recording_interval(cam_id):
+    cam = get_controllable_camera(cam_id)
+    val = request.args.get('interval', None)
+    if val is None:
+        return jsonify({'success': False, 'error': 'missing interval parameter'}), 400
+    try:
+        f = float(val)
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid interval'}), 400
+    if f < 0.01:
+        return jsonify({'success': False, 'error': 'interval must be >= 0.01'}), 400
+    with cam.recording_lock:
+        cam.recording_interval = f
+    cam.recording_wakeup.set()
+    cam.event_hub.publish('recording', recording_state(cam))
+    return jsonify({'success': True, 'interval': cam.recording_interval})
+
+
+@app.route('/set_recording_mode', defaults={'cam_id': None})
+@app.route('/set_recording_mode/<cam_id>')
+def set_recording_mode(cam_id):
+    # 参数：mode=jpeg|video，segment_seconds（视频分段时长），format=avi|mp4
+    cam = get_controllable_camera(cam_id)
+    mode = request.args.get('mode', cam.recording_mode)
+    fmt = request.args.get('format', cam.recording_video_format)
+    if mode not in ('jpeg', 'video'):
+        return jsonify({'success': False, 'error': 'mode must be jpeg or video'}), 400
+    if fmt not in VIDEO_FORMATS:
+        return jsonify({'success': False, 'error': 'format must be avi or mp4'}), 400
+    try:
+        seg = float(request.args.get('segment_seconds', cam.recording_segment_seconds))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid segment_seconds'}), 400
+    if seg < 1:
+        return jsonify({'success': False, 'error': 'segment_seconds must be >= 1'}), 400
+    with cam.recording_lock:
+        cam.recording_mode = mode
+        cam.recording_segment_seconds = seg
+        cam.recording_video_format = fmt
+    cam.recording_wakeup.set()
+    cam.event_hub.publish('recording', recording_state(cam))
+    return jsonify({'success': True, **recording_state(cam)})
+
+
+@app.route('/set_recording_trigger', defaults={'cam_id': None})
+@app.route('/set_recording_trigger/<cam_id>')
+def set_recording_trigger(cam_id):
+    # 参数：trigger=manual|motion，pre_roll / post_roll（秒）
+    cam = get_controllable_camera(cam_id)
+    trigger = request.args.get('trigger', cam.recording_trigger)
+    if trigger not in ('manual', 'motion'):
+        return jsonify({'success': False, 'error': 'trigger must be manual or motion'}), 400
+    try:
+        pre = float(request.args.get('pre_roll', cam.pre_roll_seconds))
+        post = float(request.args.get('post_roll', cam.post_roll_seconds))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid pre_roll/post_roll'}), 400
+    if pre < 0 or post < 0:
+        return jsonify({'success': False, 'error': 'pre_roll/post_roll must be >= 0'}), 400
+    if trigger == 'motion':
+        # 布防：需要摄像头与录制线程持续运行以维护预录缓冲
+        ensure_camera_started(cam)
+    with cam.recording_lock:
+        cam.recording_trigger = trigger
+        cam.pre_roll_seconds = pre
+        cam.post_roll_seconds = post
+        if trigger == 'motion':
+            cam.recording_event.set()
+        elif cam.recording_auto:
+            # 撤防时结束由运动自动开始的会话
+            cam.recording_active = False
+            cam.recording_auto = False
+            cam.recording_event.clear()
+        elif not cam.recording_active:
+            cam.recording_event.clear()
+        cam.recording_wakeup.set()
+    ensure_recording_started(cam)
+    cam.event_hub.publish('recording', recording_state(cam))
+    if trigger == 'manual':
+        # 撤防后没有观看者也没在录制时，与 /stop_recording 一样进入空闲计时释放摄像头
+        release_camera_if_idle(cam)
+    return jsonify({'success': True, **recording_state(cam)})
+
+
+@app.route('/set_recording_change', defaults={'cam_id': None})
+@app.route('/set_recording_change/<cam_id>')
+def set_recording_change(cam_id):
+    # 参数：threshold（变化像素百分比，0 关闭去重），heartbeat（静止画面的最长写入间隔，秒）
+    cam = get_controllable_camera(cam_id)
+    try:
+        threshold = float(request.args.get('threshold', cam.recording_change_threshold))
+        heartbeat = float(request.args.get('heartbeat', cam.recording_heartbeat))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid threshold/heartbeat'}), 400
+    if not 0 <= threshold <= 100:
+        return jsonify({'success': False, 'error': 'threshold must be between 0 and 100'}), 400
+    if heartbeat < 1:
+        return jsonify({'success': False, 'error': 'heartbeat must be >= 1'}), 400
+    with cam.recording_lock:
+        cam.recording_change_threshold = threshold
+        cam.recording_heartbeat = heartbeat
+    cam.recording_wakeup.set()
+    cam.event_hub.publish('recording', recording_state(cam))
+    return jsonify({'success': True, **recording_state(cam)})
+
+
+@app.route('/set_recording_writer')
+def set_recording_writer():
+    # 参数：policy=drop_oldest|drop_newest|block，queue_size（队列长度）；写盘工作池为所有摄像头共用
+    global recording_queue_policy, recording_queue_size
+    policy = request.args.get('policy', recording_queue_policy)
+    if policy not in RecordingWriter.POLICIES:
+        return jsonify({'success': False, 'error': 'policy must be drop_oldest, drop_newest or block'}), 400
+    try:
+        size = int(request.args.get('queue_size', recording_queue_size))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid queue_size'}), 400
+    if size < 1:
+        return jsonify({'success': False, 'error': 'queue_size must be >= 1'}), 400
+    recording_queue_policy = policy
+    recording_queue_size = size
+    if recording_writer is not None:
+        recording_writer.policy = policy
+        recording_writer.set_queue_size(size)
+    return jsonify({'success': True, **recording_state(get_camera())})
+
+
+@app.route('/set_retention')
+def set_retention():
+    # 参数：max_bytes（总占用上限，字节）、max_age / compact_after / timelapse_step（秒）、
+    # io_rate（限速，字节/秒），均以 0 表示不限制；修改后立即执行一轮清理
+    global retention_max_bytes, retention_max_age, retention_compact_after, retention_timelapse_step
+    global retention_io_rate
+    try:
+        max_bytes = int(request.args.get('max_bytes', retention_max_bytes))
+        max_age = float(request.args.get('max_age', retention_max_age))
+        compact_after = float(request.args.get('compact_after', retention_compact_after))
+        step = float(request.args.get('timelapse_step', retention_timelapse_step))
+        io_rate = int(request.args.get('io_rate', retention_io_rate))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid retention parameter'}), 400
+    if min(max_bytes, max_age, compact_after, io_rate) < 0:
+        return jsonify({'success': False, 'error': 'retention parameters must be >= 0'}), 400
+    if step <= 0:
+        return jsonify({'success': False, 'error': 'timelapse_step must be > 0'}), 400
+    retention_max_bytes, retention_max_age, retention_compact_after = max_bytes, max_age, compact_after
+    retention_timelapse_step, retention_io_rate = step, io_rate
+    manager = get_retention_manager()
+    manager.max_bytes, manager.max_age, manager.compact_after = max_bytes, max_age, compact_after
+    manager.timelapse_step, manager.io_rate = step, io_rate
+    manager.trigger()
+    return jsonify({'success': True, **manager.stats()})
+
+
+def camera_state(cam):
+    return {
+        'open': cam.device is not None,
+        'idle': cam.device is not None and cam.idle_since is not None,
+        'idle_grace': cam.idle_grace,
+        'keepalive_fps': cam.keepalive_fps,
+    }
+
+
+@app.route('/set_camera_idle', defaults={'cam_id': None})
+@app.route('/set_camera_idle/<cam_id>')
+def set_camera_idle(cam_id):
+    # 参数：grace（最后一个使用者离开后保持打开的秒数），keepalive_fps（宽限期内的采集帧率，0 为全速）
+    cam = get_camera(cam_id)
+    try:
+        grace = float(request.args.get('grace', cam.idle_grace))
+        keepalive = float(request.args.get('keepalive_fps', cam.keepalive_fps))
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid grace/keepalive_fps'}), 400
+    if grace < 0 or keepalive < 0:
+        return jsonify({'success': False, 'error': 'grace/keepalive_fps must be >= 0'}), 400
+    cam.idle_grace = grace
+    cam.keepalive_fps = keepalive
+    cam.wakeup.set()
+    return jsonify({'success': True, **camera_state(cam)})
+
+
+@app.route('/motion_config', defaults={'cam_id': None})
+@app.route('/motion_config/<cam_id>')
+def motion_config(cam_id):
+    return jsonify(get_camera(cam_id).motion_detector.config())
+
+
+@app.route('/set_motion_config', defaults={'cam_id': None})
+@app.route('/set_motion_config/<cam_id>')
+def set_motion_config(cam_id):
+    # 支持参数：detect_width, diff_threshold, min_area, bg_alpha,
+    # rois（格式 "x,y,w,h;x,y,w,h"，空字符串表示整幅画面）
+    cam = get_controllable_camera(cam_id)
+    updates = {}
+    try:
+        if 'detect_width' in request.args:
+            updates['detect_width'] = int(request.args['detect_width'])
+        if 'diff_threshold' in request.args:
+            updates['diff_threshold'] = int(request.args['diff_threshold'])
+        if 'min_area' in request.args:
+            updates['min_area'] = float(request.args['min_area'])
+        if 'bg_alpha' in request.args:
+            updates['bg_alpha'] = float(request.args['bg_alpha'])
+        if 'rois' in request.args:
+            rois = []
+            for part in request.args['rois'].split(';'):
+                if part.strip():
+                    x, y, w, h = (int(v) for v in part.split(','))
+                    rois.append((x, y, w, h))
+            updates['rois'] = rois
+    except Exception:
+        return jsonify({'success': False, 'error': 'invalid parameter'}), 400
+    if not updates:
+        return jsonify({'success': False, 'error': 'no parameters given'}), 400
+    if updates.get('detect_width', 0) < 0:
+        return jsonify({'success': False, 'error': 'detect_width must be >= 0'}), 400
+    if not 0 <= updates.get('diff_threshold', 0) <= 255:
+        return jsonify({'success': False, 'error': 'diff_threshold must be in 0..255'}), 400
+    if updates.get('min_area', 0) < 0:
+        return jsonify({'success': False, 'error': 'min_area must be >= 0'}), 400
+    if not 0 < updates.get('bg_alpha', 0.1) <= 1:
+        return jsonify({'success': False, 'error': 'bg_alpha must be in (0, 1]'}), 400
+    if any(w <= 0 or h <= 0 for (_, _, w, h) in updates.get('rois', [])):
+        return jsonify({'success': False, 'error': 'roi width/height must be > 0'}), 400
+    cam.motion_detector.configure(**updates)
+    return jsonify({'success': True, **cam.motion_detector.config()})
+
+def register_client(cam):
+    # 注册为活跃客户端，并确保摄像头已启动（如果需要的话会启动线程并打开摄像头）
+    with cam.clients_lock:
+        cam.active_clients += 1
+    ensure_camera_started(cam)
+    return str(next(client_ids))
+
+
+def unregister_client(cam, client):
+    # 注销活跃客户端；如果没有剩余客户端则关闭摄像头释放资源
+    for name in ('camera_client_fps', 'camera_client_frames_total', 'camera_client_skipped_frames_total',
+                 'camera_client_lag_seconds'):
+        metrics.remove(name, client=client)
+    with cam.clients_lock:
+        cam.active_clients -= 1
+        remaining = cam.active_clients
+    if remaining == 0:
+        release_camera_if_idle(cam)
+
+
+def camera_in_use(cam):
+    # 有流客户端、正在录制或运动触发录制已布防（录制线程需要持续帧）
+    with cam.recording_lock:
+        is_recording = bool(cam.recording_active) or cam.recording_trigger == 'motion'
+    return is_recording or cam.active_clients > 0
+
+
+def release_camera_if_idle(cam):
+    # 不立即关闭设备，只标记为空闲；采集线程在宽限期满且仍无人使用时才释放，
+    # 宽限期内回来的客户端可以直接拿到帧
+    if camera_in_use(cam):
+        return
+    with cam.lock:
+        if cam.idle_since is None:
+            cam.idle_since = time.time()
+    cam.wakeup.set()
+
+
+def stream_part(jpeg, capture_ts):
+    # X-Timestamp 为采集时刻，供压测工具计算端到端延迟（浏览器会忽略）
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'Content-Length: %d\r\n'
+            b'X-Timestamp: %.6f\r\n\r\n' % (len(jpeg), capture_ts) +
+            jpeg + b'\r\n')
+
+
+class ClientMeter:
+    """单个流客户端的发送统计：写套接字耗时、落后时长、实际帧率、跳帧数。
+
+    每个连接总是发送最新帧：上一帧还没写完（套接字不可写）时产生的中间帧直接跳过，
+    因此慢客户端只会降低自己的帧率，不会在服务器端堆积缓冲。统计写入 /metrics，
+    并可通过 /clients 查看。
+    """
+
+    def __init__(self, client, remote='', profile=None, camera=''):
+        self.client = client
+        self.camera = camera
+        self.remote = remote
+        self.profile = profile
+        self.connected = time.time()
+        self.frames = 0
+        self.skipped_total = 0
+        self.last_write_ms = 0.0
+        self._writing_since = None
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self._window_start = time.perf_counter()
+        self._window_frames = 0
+        self.fps = 0.0
+        with stream_clients_lock:
+            stream_clients[client] = self
+
+    def skipped(self, n):
+        if n:
+            self.skipped_total += n
+            metrics.inc('camera_client_skipped_frames_total', n, client=self.client)
+
+    def begin(self):
+        # 开始写一帧；写入一直挂起说明客户端跟不上，/clients 中显示为 pending_write_ms
+        self._writing_since = time.perf_counter()
+        return self._writing_since
+
+    def sent(self, start, capture_ts=None):
+        now = time.perf_counter()
+        self._writing_since = None
+        write = now - start
+        metrics.observe('camera_stage_seconds', write, stage='socket_yield')
+        metrics.inc('camera_client_frames_total', client=self.client)
+        self.frames += 1
+        self.last_write_ms = write * 1000
+        if capture_ts is not None:
+            # 落后时长：采集时刻到这一帧写完（进入内核发送缓冲）为止
+            lag = max(0.0, time.time() - capture_ts)
+            self.lag_ms = lag * 1000 if self.frames == 1 else self.lag_ms * 0.8 + lag * 200
+            self.max_lag_ms = max(self.max_lag_ms, lag * 1000)
+            metrics.set('camera_client_lag_seconds', round(lag, 4), client=self.client)
+        # 按 1 秒窗口统计该客户端实际收到的帧率
+        self._window_frames += 1
+        if now - self._window_start >= 1.0:
+            self.fps = self._window_frames / (now - self._window_start)
+            metrics.set('camera_client_fps', round(self.fps, 2), client=self.client)
+            self._window_start = now
+            self._window_frames = 0
+
+    def close(self):
+        with stream_clients_lock:
+            stream_clients.pop(self.client, None)
+
+    def stats(self):
+        since = self._writing_since
+        return {
+            'client': self.client,
+            'camera': self.camera,
+            'remote': self.remote,
+            'profile': dict(zip(('width', 'fps', 'quality'), self.profile)) if self.profile else None,
+            'connected_seconds': round(time.time() - self.connected, 1),
+            'frames': self.frames,
+            'skipped': self.skipped_total,
+            'fps': round(self.fps, 2),
+            'last_write_ms': round(self.last_write_ms, 2),
+            'pending_write_ms': round((time.perf_counter() - since) * 1000, 1) if since is not None else 0.0,
+            'lag_ms': round(self.lag_ms, 1),
+            'max_lag_ms': round(self.max_lag_ms, 1),
+        }
+
+
+def limit_send_buffer(sock):
+    # 缩小套接字发送缓冲：内核里最多积压一两帧，慢链路会更早表现为“不可写”，
+    # 从而跳帧而不是让延迟越积越大
+    if sock is None or not stream_send_buffer_bytes:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, stream_send_buffer_bytes)
+    except Exception:
+        pass
+
+
+def generate(cam, width=0, fps=0.0, quality=0, remote=''):
+    client = register_client(cam)
+    # 在生成器内部订阅码流配置，保证与 finally 中的释放成对出现
+    profile = acquire_stream_profile(cam, width, fps, quality)
+    meter = ClientMeter(client, remote, profile.key, cam.id)
+    last_seq = 0
+    try:
+        while True:
+            # 等待该码流配置产出比上次更新的一帧（已编码），不再逐客户端拷贝/绘制/编码
+            got = profile.bus.wait(last_seq, timeout=1.0)
+            if got is None:
+                continue
+            last_seq, capture_ts, jpeg, skipped = got
+            meter.skipped(skipped)
+
+            # yield 返回所需时间即 WSGI 层把这一帧写入套接字的耗时；写入期间到达的
+            # 帧不会排队，下一轮直接取最新帧（跳过的数量记在 skipped 中）
+            start = meter.begin()
+            yield stream_part(jpeg, capture_ts)
+            meter.sent(start, capture_ts)
+    except GeneratorExit:
+        # 客户端断开时会抛出 GeneratorExit，继续到 finally
+        pass
+    finally:
+        meter.close()
+        release_stream_profile(cam, profile)
+        unregister_client(cam, client)
+
+def parse_stream_params(args):
+    # 可选参数：width（输出宽度，按比例缩放）、fps（服务器端限帧）、quality（JPEG 质量 1-100）
+    # 返回 ((width, fps, quality), None) 或 (None, 错误信息)
+    try:
+        width = int(args.get('width', 0))
+        fps = float(args.get('fps', 0))
+        quality = int(args.get('quality', 0))
+    except Exception:
+        return None, 'invalid width/fps/quality'
+    if width < 0 or (width and width < 16):
+        return None, 'width must be >= 16'
+    if fps < 0 or fps > 120:
+        return None, 'fps must be in 0..120'
+    if quality < 0 or quality > 100:
+        return None, 'quality must be in 0..100 (0 = default)'
+    return (width, fps, quality), None
+
+
+def parse_snapshot_params(args):
+    # 可选参数：width、quality（同 /video_feed）；after=序号 表示只要比该序号更新的帧（长轮询），
+    # timeout 为最长等待秒数。返回 ((width, quality, after, timeout), None) 或 (None, 错误信息)
+    params, error = parse_stream_params({k: v for k, v in args.items() if k in ('width', 'quality')})
+    if error:
+        return None, error
+    try:
+        after = int(args['after']) if args.get('after') not in (None, '') else None
+        timeout = float(args.get('timeout', 5.0))
+    except Exception:
+        return None, 'invalid after/timeout'
+    if timeout < 0 or timeout > 30:
+        return None, 'timeout must be in 0..30'
+    return (params[0], params[2], after, timeout), None
+
+
+def snapshot_wait_seq(latest, after):
+    # 返回需要等待的序号；None 表示直接返回当前最新帧。
+    # after 大于当前序号说明它来自已重建的旧管线，此时也直接返回最新帧
+    seq, _, jpeg = latest
+    if jpeg is None or (after is not None and seq == after):
+        return seq
+    return None
+
+
+def snapshot_headers(profile, seq, capture_ts):
+    return [('ETag', f'"{profile.epoch}-{seq}"'),
+            ('X-Sequence', str(seq)),
+            ('X-Timestamp', '%.6f' % capture_ts),
+            ('Cache-Control', 'no-cache')]
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+@app.route('/snapshot.jpg', defaults={'cam_id': None})
+@app.route('/snapshot/<cam_id>.jpg')
+def snapshot(cam_id):
+    # 返回最新一帧已编码的 JPEG：所有轮询者共享编码管线，每帧只编码一次
+    cam = get_camera(cam_id)
+    params, error = parse_snapshot_params(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    width, quality, after, timeout = params
+    ensure_camera_started(cam)
+    profile = acquire_stream_profile(cam, width, 0.0, quality)
+    try:
+        latest = profile.bus.latest()
+        wait_seq = snapshot_wait_seq(latest, after)
+        got = latest if wait_seq is None else profile.bus.wait(wait_seq, timeout)
+    finally:
+        release_stream_profile(cam, profile)
+        release_camera_if_idle(cam)
+    if got is None:
+        if latest[2] is None:
+            metrics.inc('camera_snapshot_requests_total', status='503')
+            return jsonify({'success': False, 'error': 'no frame available'}), 503
+        # 长轮询超时：客户端手里的已是最新帧
+        got = latest
+    seq, capture_ts, jpeg = got[:3]
+    headers = snapshot_headers(profile, seq, capture_ts)
+    if etag_matches(request.headers.get('If-None-Match'), headers[0][1]) or seq == after:
+        metrics.inc('camera_snapshot_requests_total', status='304')
+        return Response(status=304, headers=headers)
+    metrics.inc('camera_snapshot_requests_total', status='200')
+    return Response(jpeg, mimetype='image/jpeg', headers=headers)
+
+
+@app.route('/video_feed', defaults={'cam_id': None})
+@app.route('/video_feed/<cam_id>')
+def video_feed(cam_id):
+    cam = get_camera(cam_id)
+    params, error = parse_stream_params(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    # 开发服务器与 gunicorn 分别在 environ 中提供底层套接字
+    limit_send_buffer(request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket'))
+    return Response(generate(cam, *params, remote=request.remote_addr or ''),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 # 确保摄像头已打开并启动摄像头线程（若尚未启动）
-def ensure_camera_started():
-    global camera, camera_thread_started
-    with camera_thread_lock:
-        if camera is None:
-            try:
-                camera = cv2.VideoCapture(0)
-            except Exception:
-                camera = None
-        if not camera_thread_started:
-            t = threading.Thread(target=camera_loop, daemon=True)
-            t.start()
-            camera_thread_started = True
+def ensure_camera_started(cam):
+    use_shm = bool(shm_name) and cam.id == default_camera_id
+    with cam.lock:
+        # 取消空闲计时；摄像头由采集线程打开，这里只发出请求并唤醒它
+        cam.idle_since = None
+        if cam.device is None and not use_shm and cam.requested_at is None:
+            cam.requested_at = time.time()
+        cam.wakeup.set()
+        if not cam.thread_started and use_shm:
+            # 共享内存模式：默认摄像头的帧与运动状态来自采集进程
+            threading.Thread(target=shm_reader_loop, args=(cam,), daemon=True).start()
+            cam.thread_started = True
+        if not cam.thread_started:
+            # 采集线程只负责取帧；新帧到达时把检测任务提交到分析线程池，
+            # 慢的检测不会拖慢取帧
+            cam.capture_ring.add_listener(lambda: schedule_analysis(cam))
+            threading.Thread(target=capture_loop, args=(cam,), daemon=True).start()
+            cam.thread_started = True
 
 # ======================
 # 摄像头 + 运动检测
 # ======================
-def camera_loop():
-    global output_frame, motion_detected, camera
+def acquire_stream_profile(cam, width=0, fps=0.0, quality=0):
+    # 相同配置的客户端共享同一条编码管线；无观看者时不做任何编码
+    key = (width, float(fps), quality)
+    with cam.stream_profiles_lock:
+        profile = cam.stream_profiles.get(key)
+        if profile is None:
+            profile = StreamProfile(cam.frame_bus, width, float(fps), quality)
+            cam.stream_profiles[key] = profile
+            profile.start()
+        profile.subscribers += 1
+        return profile
+
+
+def release_stream_profile(cam, profile):
+    with cam.stream_profiles_lock:
+        profile.subscribers -= 1
+        if profile.subscribers > 0:
+            return
+        if stream_profile_linger > 0:
+            # 暂不拆除，留一段时间给紧接着的请求复用
+            profile.released_at = released_at = time.time()
+            timer = threading.Timer(stream_profile_linger, reap_stream_profile, (cam, profile, released_at))
+            timer.daemon = True
+            timer.start()
+            return
+        profile.stop()
+        if cam.stream_profiles.get(profile.key) is profile:
+            del cam.stream_profiles[profile.key]
 
-    prev_frame = None
+
+def reap_stream_profile(cam, profile, released_at):
+    # 保留期满且期间没有新的订阅者时拆除编码管线
+    with cam.stream_profiles_lock:
+        if profile.subscribers > 0 or profile.released_at != released_at:
+            return
+        profile.stop()
+        if cam.stream_profiles.get(profile.key) is profile:
+            del cam.stream_profiles[profile.key]
+
+
+def open_camera(cam):
+    # 由采集线程调用：打开帧源，失败时返回 None
+    try:
+        source = open_frame_source(cam.source)
+    except Exception:
+        return None
+    metrics.inc('camera_open_total', camera=cam.id)
+    return source
+
+
+def release_idle_camera(cam):
+    # 宽限期已满且确实无人使用时释放设备并返回 True；期间又有使用者则取消空闲。
+    # 在锁内完成释放，避免与 ensure_camera_started() 的打开请求交错
+    with cam.lock:
+        if cam.idle_since is None:
+            return False
+        if camera_in_use(cam):
+            cam.idle_since = None
+            return False
+        if time.time() - cam.idle_since < cam.idle_grace:
+            return False
+        try:
+            cam.device.release()
+        except Exception:
+            pass
+        cam.device = None
+        cam.idle_since = None
+    metrics.inc('camera_close_total', camera=cam.id)
+    metrics.set('camera_capture_fps', 0, camera=cam.id)
+    return True
+
+
+def capture_loop(cam):
+    # 采集线程：按设备交付的节奏尽快取帧发布到采集总线，驱动缓冲不会积压旧帧；
+    # 摄像头的打开与释放都只在这个线程中进行，避免与 read() 并发
+    fps_window_start = time.time()
+    fps_window_frames = 0
 
     while True:
-        # 如果摄像头尚未初始化或为 None，短暂休眠等待
-        if camera is None:
-            time.sleep(0.1)
+        if cam.device is not None and release_idle_camera(cam):
+            continue
+
+        if cam.device is None:
+            # 没有打开请求时阻塞等待唤醒，不再固定间隔轮询
+            if cam.requested_at is None:
+                cam.wakeup.wait()
+                cam.wakeup.clear()
+                continue
+            cam.device = open_camera(cam)
+            if cam.device is None:
+                metrics.inc('camera_reopen_total', camera=cam.id)
+                time.sleep(1)
             continue
 
         # 如果摄像头未打开，尝试释放并重建 VideoCapture
         try:
-            opened = camera.isOpened()
+            opened = cam.device.isOpened()
         except Exception:
             opened = False
 
         if not opened:
             try:
-                camera.release()
+                cam.device.release()
             except Exception:
                 pass
-            try:
-                camera = cv2.VideoCapture(0)
-            except Exception:
-                camera = None
+            cam.device = open_camera(cam)
+            metrics.inc('camera_reopen_total', camera=cam.id)
             time.sleep(1)
             continue
 
-        ret, frame = camera.read()
+        # read() 会阻塞到设备产出下一帧，因此无需额外的固定休眠；
+        # 帧直接解码进池中空闲的缓冲，稳态下不再逐帧分配整帧内存
+        start = time.perf_counter()
+        buf = cam.frame_pool.acquire()
+        try:
+            ret, frame = cam.device.read(buf)
+        except Exception:
+            ret, frame = False, None
+        metrics.observe('camera_stage_seconds', time.perf_counter() - start, stage='camera_read')
+        capture_ts = time.time()
         if not ret:
             # 读帧失败：释放并重建摄像头，然后短暂等待
             try:
-                camera.release()
-            except:
+                cam.device.release()
+            except Exception:
                 pass
-            camera = cv2.VideoCapture(0)
+            cam.device = open_camera(cam)
+            metrics.inc('camera_reopen_total', camera=cam.id)
             time.sleep(1)
             continue
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+        requested_at = cam.requested_at
+        if requested_at is not None:
+            metrics.observe('camera_first_frame_seconds', max(0.0, capture_ts - requested_at), camera=cam.id)
+            cam.requested_at = None
+        cam.frames_captured += 1
+        # 按 1 秒窗口统计采集帧率
+        fps_window_frames += 1
+        if capture_ts - fps_window_start >= 1.0:
+            metrics.set('camera_capture_fps', round(fps_window_frames / (capture_ts - fps_window_start), 2),
+                        camera=cam.id)
+            fps_window_start = capture_ts
+            fps_window_frames = 0
+        if frame is not buf:
+            cam.frame_pool.adopt(frame)
+        cam.capture_ring.publish(frame, capture_ts)
+        # 不在本线程留引用，借出的缓冲被下游用完后即可回到池中
+        frame = buf = None
+
+        if cam.idle_since is not None and cam.keepalive_fps > 0:
+            # 宽限期内降速保活：设备保持打开，新的使用者会立即唤醒恢复全速
+            if cam.wakeup.wait(timeout=1.0 / cam.keepalive_fps):
+                cam.wakeup.clear()
+
+
+def schedule_analysis(cam):
+    # 采集总线的发布监听（在采集线程中调用）：该摄像头没有排队或运行中的分析任务时提交一个
+    with cam.analysis_lock:
+        if cam.analysis_scheduled:
+            return
+        cam.analysis_scheduled = True
+    analysis_pool.submit(analysis_task, cam)
+
 
-        if prev_frame is None:
-            prev_frame = gray
-            # 在首次帧上添加时间水印
+def analysis_task(cam):
+    # 分析任务：处理采集总线上最新的一帧，处理不过来时丢弃中间帧。
+    # 结束前若已有更新的帧则重新提交，同一摄像头的帧始终按顺序、串行分析
+    try:
+        got = cam.capture_ring.wait(cam.analysis_seq, timeout=0)
+        if got is not None:
+            analyze_frame(cam, got)
+    finally:
+        with cam.analysis_lock:
+            if cam.capture_ring.latest()[0] > cam.analysis_seq:
+                analysis_pool.submit(analysis_task, cam)
+            else:
+                cam.analysis_scheduled = False
+
+
+def set_motion_state(cam, motion, capture_ts):
+    # 仅在状态翻转时推送，页面无需轮询 /status；同时记录起止时刻并唤醒录制线程，
+    # 运动触发录制不必等到下一个录制间隔
+    if motion == cam.motion_detected:
+        return
+    if motion:
+        cam.motion_started_ts = capture_ts
+    else:
+        cam.motion_ended_ts = capture_ts
+    cam.motion_detected = motion
+    cam.event_hub.publish('motion', {'motion': motion, 'ts': capture_ts})
+    cam.recording_wakeup.set()
+
+
+def analyze_frame(cam, got):
+    cam.analysis_seq, capture_ts, frame, dropped = got
+    cam.frames_dropped += dropped
+    cam.frames_analyzed += 1
+
+    # 检测只读取原始帧；检测框为原始分辨率坐标
+    boxes = cam.motion_detector.detect(frame)
+    set_motion_state(cam, bool(boxes), capture_ts)
+
+    # 采集总线上的帧只交给分析阶段，检测框和水印直接画在池缓冲上，无需整帧拷贝
+    overlay_start = time.perf_counter()
+    for (x, y, w, h) in boxes:
+        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+
+    # 前端负责播放声音和闪红边框，服务器端不再发声。
+
+    # 在输出帧左下角添加时间水印（预渲染缓存，每秒只光栅化一次）
+    try:
+        timestamp_overlay.stamp(frame, capture_ts)
+    except Exception:
+        pass
+    metrics.observe('camera_stage_seconds', time.perf_counter() - overlay_start, stage='overlay')
+    # 下游拿到只读视图，发布只是交换一个引用；缓冲在所有视图释放后回到池中
+    cam.frame_bus.publish(FramePool.readonly(frame), capture_ts)
+
+
+def shm_writer_loop(cam, name):
+    # 采集进程：把带标注的输出帧和运动状态写入共享内存帧环
+    ring = None
+    last_seq = 0
+    try:
+        while True:
+            got = cam.frame_bus.wait(last_seq, timeout=1.0)
+            if got is None:
+                continue
+            last_seq, capture_ts, frame, _ = got
+            if ring is None:
+                ring = SharedFrameRing.create(name, frame.shape, shm_slots)
+            ring.write(frame, capture_ts, cam.motion_detected)
+    finally:
+        if ring is not None:
+            ring.close()
+
+
+def shm_reader_loop(cam):
+    # Web 工作进程：轮询共享内存帧环的序号（跨进程无法共享条件变量），
+    # 有新帧时以零拷贝视图发布到本进程的 frame_bus，并同步运动状态
+    ring = None
+    last_seq = 0
+    last_change = time.time()
+    while True:
+        if ring is None:
+            try:
+                ring = SharedFrameRing.attach(shm_name)
+                last_seq = 0
+                last_change = time.time()
+            except (FileNotFoundError, ValueError):
+                time.sleep(1)
+                continue
+        seq = ring.latest_seq()
+        if seq == last_seq:
+            # 长时间无新帧：采集进程可能已重启并重建了共享段，重新连接
+            if time.time() - last_change > 5:
+                ring.close()
+                ring = None
+                continue
+            time.sleep(0.005)
+            continue
+        got = ring.read(seq)
+        if got is None:
+            continue
+        if last_seq and seq > last_seq + 1:
+            cam.frames_dropped += seq - last_seq - 1
+        if seq < last_seq:
+            last_seq = 0
+        last_seq, capture_ts, view, motion = got
+        last_change = time.time()
+        cam.frames_captured += 1
+        cam.frames_analyzed += 1
+        set_motion_state(cam, motion, capture_ts)
+        cam.frame_bus.publish(view, capture_ts)
+
+
+def run_capture_process(name):
+    # 独立采集进程：默认摄像头的采集 + 运动检测，结果写入共享内存，供任意数量的 Web 工作进程读取
+    # SIGTERM 转为正常退出，保证 finally 中删除共享内存段
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    cam = get_camera()
+    ensure_camera_started(cam)
+    shm_writer_loop(cam, name)
+
+
+# ======================
+# 录制后台线程（每隔10秒保存一张图片）
+# ======================
+# 视频容器格式 -> (扩展名, fourcc)
+VIDEO_FORMATS = {
+    'avi': ('.avi', 'MJPG'),
+    'mp4': ('.mp4', 'mp4v'),
+}
+
+
+def save_jpeg_path(target_dir, capture_ts):
+    # 文件名带毫秒，避免同一秒内的多帧互相覆盖
+    tstr = time.strftime('%Y%m%d_%H%M%S', time.localtime(capture_ts))
+    ms = int((capture_ts % 1) * 1000)
+    return os.path.join(target_dir, f"img-{tstr}_{ms:03d}.jpg")
+
+
+class SegmentWriter:
+    """把帧追加写入按时长轮转的视频分段。
+
+    每个分段 seg-YYYYmmdd_HHMMSS.<ext> 旁边有一个同名 .idx 索引（CSV：帧序号,时间戳），
+    回放时以索引中的真实采集时间为准，容器里的帧率只是名义值。
+    保留清理生成的延时视频使用同样的格式，只是前缀为 timelapse。
+    """
+
+    def __init__(self, target_dir, fmt='avi', segment_seconds=300.0, fps=10.0, prefix='seg'):
+        self.target_dir = target_dir
+        self.fmt = fmt
+        self.segment_seconds = segment_seconds
+        self.fps = fps
+        self.prefix = prefix
+        self._writer = None
+        self._index = None
+        self._size = None
+        self._started = 0.0
+        self._count = 0
+        self.path = None
+
+    def _open(self, capture_ts, size):
+        ext, fourcc = VIDEO_FORMATS[self.fmt]
+        tstr = time.strftime('%Y%m%d_%H%M%S', time.localtime(capture_ts))
+        base = os.path.join(self.target_dir, f"{self.prefix}-{tstr}")
+        self.path = base + ext
+        self._writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*fourcc), self.fps, size)
+        if not self._writer.isOpened():
+            self._writer = None
+            raise IOError(f"cannot open video writer for {self.path}")
+        # 行缓冲：每帧一行，进程异常退出时索引也基本完整
+        self._index = open(base + '.idx', 'w', buffering=1)
+        self._index.write('frame,timestamp\n')
+        self._size = size
+        self._started = capture_ts
+        self._count = 0
+
+    def write(self, capture_ts, frame):
+        h, w = frame.shape[:2]
+        if (self._writer is None or (w, h) != self._size
+                or capture_ts - self._started >= self.segment_seconds):
+            self.close()
+            self._open(capture_ts, (w, h))
+        self._writer.write(frame)
+        self._index.write(f"{self._count},{capture_ts:.3f}\n")
+        self._count += 1
+        return self.path, self._count - 1
+
+    def close(self):
+        if self._writer is not None:
+            try:
+                self._writer.release()
+            except Exception:
+                pass
+            self._writer = None
+        if self._index is not None:
             try:
-                timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                h, w = frame.shape[:2]
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                scale = 0.6
-                thickness = 2
-                text_size = cv2.getTextSize(timestamp, font, scale, thickness)[0]
-                x = 10
-                y = h - 10
-                # 黑色底色以提高可读性
-                cv2.putText(frame, timestamp, (x, y), font, scale, (0, 0, 0), thickness + 2, cv2.LINE_AA)
-                cv2.putText(frame, timestamp, (x, y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+                self._index.close()
             except Exception:
                 pass
+            self._index = None
 
-            with lock:
-                output_frame = frame.copy()
-            time.sleep(0.03)
-            continue
 
-        frame_delta = cv2.absdiff(prev_frame, gray)
-        thresh = cv2.threshold(frame_delta, 20, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.dilate(thresh, None, iterations=2)
+def read_segment_index(path):
+    # 读取分段索引，返回 [(帧序号, 时间戳), ...]；跳过表头和残缺的行
+    rows = []
+    with open(path) as f:
+        next(f, None)
+        for line in f:
+            try:
+                index, ts = line.strip().split(',')
+                rows.append((int(index), float(ts)))
+            except ValueError:
+                continue
+    return rows
 
-        contours, _ = cv2.findContours(
-            thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        motion_detected = False
-        for c in contours:
-            if cv2.contourArea(c) < 50:
+def segment_video_path(idx_path):
+    # 分段索引对应的视频文件（扩展名随容器格式），不存在时返回 None
+    base = idx_path[:-len('.idx')]
+    return next((base + ext for ext, _ in VIDEO_FORMATS.values() if os.path.exists(base + ext)), None)
+
+
+class RecordingWriter:
+    """录制写盘工作池：帧选择阶段只负责入队，由若干写线程异步落盘。
+
+    队列有界，满时按策略处理：'drop_oldest' 丢弃队首最旧的帧，'drop_newest'
+    丢弃新提交的帧，'block' 阻塞提交方直到有空位。视频分段必须按顺序写入，
+    因此出队与分段写入采用交接加锁（先拿到分段锁再释放出队锁）保证顺序；
+    JPEG 帧可以被多个线程并行写入。多个摄像头共用一个工作池，每个录制目录
+    各自有一个打开的分段。
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, workers=2, queue_size=32, policy='drop_oldest'):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self._get_lock = threading.Lock()
+        self._segment_lock = threading.Lock()
+        # 录制目录 -> 当前打开的 SegmentWriter
+        self._segments = {}
+        self._stats_lock = threading.Lock()
+        self._written = 0
+        self._dropped = 0
+        self._errors = 0
+        self._last_error = ''
+        self._last_latency = 0.0
+        self._avg_latency = 0.0
+        self._max_latency = 0.0
+        for _ in range(max(1, workers)):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def set_queue_size(self, size):
+        # queue.Queue 在每次 put 时读取 maxsize，可以直接调整
+        with self._queue.mutex:
+            self._queue.maxsize = size
+
+    def submit(self, target_dir, capture_ts, frame, mode='jpeg', fmt='avi', segment_seconds=300.0, fps=10.0,
+               jpeg=None, motion=False, cam=None):
+        # frame 为 BGR 帧；也可以只给已编码的 jpeg 字节（例如预录缓冲中的帧）。
+        # 给出 cam 时，真正落盘后才计入该摄像头的写入计数（被队列丢弃的帧不算）
+        job = ('frame', target_dir, capture_ts, frame, mode, fmt, segment_seconds, fps, jpeg, motion, cam)
+        if self.policy == 'block':
+            self._queue.put(job)
+            return True
+        if self.policy == 'drop_newest':
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except queue.Full:
+                self._count_drop(job)
+                return False
+        # drop_oldest：挤掉最旧的一帧，保证新帧入队
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except queue.Full:
+                if not self._drop_oldest_frame():
+                    # 队列里只剩控制消息：等它们被处理
+                    self._queue.put(job)
+                    return True
+
+    def _drop_oldest_frame(self):
+        # 控制消息（关闭分段）不能丢：丢了分段就不会被关闭，容器无法播放、索引文件句柄泄漏。
+        # 跳过它们，只移除最旧的帧任务，其余任务保持原有顺序
+        with self._queue.mutex:
+            pending = self._queue.queue
+            for i, dropped in enumerate(pending):
+                if dropped[0] == 'frame':
+                    del pending[i]
+                    self._queue.not_full.notify()
+                    break
+            else:
+                return False
+        self._count_drop(dropped)
+        return True
+
+    def close_segment(self, target_dir=None):
+        # 控制消息不受丢弃策略影响，按顺序在已入队的帧之后关闭该目录（缺省为全部）的分段
+        self._queue.put(('close', target_dir))
+
+    def _count_drop(self, job):
+        with self._stats_lock:
+            self._dropped += 1
+        if job[10] is not None:
+            metrics.inc('camera_recording_frames_total', camera=job[10].id, result='dropped')
+
+    def _worker(self):
+        while True:
+            ordered = False
+            with self._get_lock:
+                job = self._queue.get()
+                if job[0] == 'close' or job[4] == 'video':
+                    self._segment_lock.acquire()
+                    ordered = True
+            try:
+                if job[0] == 'close':
+                    self._close_segment_locked(job[1])
+                else:
+                    self._write(job)
+            finally:
+                if ordered:
+                    self._segment_lock.release()
+
+    def _close_segment_locked(self, target_dir=None):
+        for key in [target_dir] if target_dir is not None else list(self._segments):
+            seg = self._segments.pop(key, None)
+            if seg is not None:
+                seg.close()
+
+    def _write(self, job):
+        _, target_dir, capture_ts, frame, mode, fmt, segment_seconds, fps, jpeg, motion, cam = job
+        start = time.perf_counter()
+        # 视频帧没有单独的文件大小，目录中记为 NULL
+        offset = size = None
+        try:
+            if mode == 'video':
+                if frame is None:
+                    frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                seg = self._segments.get(target_dir)
+                # 分段参数变化时结束当前分段
+                if seg is not None and (seg.fmt != fmt or seg.segment_seconds != segment_seconds):
+                    self._close_segment_locked(target_dir)
+                    seg = None
+                if seg is None:
+                    seg = self._segments[target_dir] = SegmentWriter(target_dir, fmt, segment_seconds, fps)
+                path, offset = seg.write(capture_ts, frame)
+            elif jpeg is not None:
+                # 已编码的帧直接落盘，无需解码再编码
+                path = save_jpeg_path(target_dir, capture_ts)
+                with open(path, 'wb') as f:
+                    f.write(jpeg)
+                size = len(jpeg)
+            else:
+                path = save_jpeg_path(target_dir, capture_ts)
+                if not cv2.imwrite(path, frame):
+                    raise IOError('cv2.imwrite failed')
+                size = os.path.getsize(path)
+        except Exception as e:
+            if mode == 'video':
+                self._close_segment_locked(target_dir)
+            with self._stats_lock:
+                self._errors += 1
+                self._last_error = f"{type(e).__name__}: {e}"
+            return
+        latency = time.perf_counter() - start
+        metrics.observe('camera_stage_seconds', latency, stage='disk_write')
+        get_recording_catalog().add_frame(target_dir, capture_ts, path, offset, size, motion)
+        with self._stats_lock:
+            self._written += 1
+            self._last_latency = latency
+            self._max_latency = max(self._max_latency, latency)
+            # 指数滑动平均，反映最近的磁盘延迟
+            self._avg_latency = latency if self._written == 1 else self._avg_latency * 0.9 + latency * 0.1
+            if cam is not None:
+                cam.recording_frames_written += 1
+        if cam is not None:
+            metrics.inc('camera_recording_frames_total', camera=cam.id, result='written')
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'policy': self.policy,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self._queue.maxsize,
+                'written': self._written,
+                'dropped': self._dropped,
+                'errors': self._errors,
+                'last_error': self._last_error,
+                'write_latency_ms': {
+                    'last': round(self._last_latency * 1000, 2),
+                    'avg': round(self._avg_latency * 1000, 2),
+                    'max': round(self._max_latency * 1000, 2),
+                },
+            }
+
+
+class PreRollBuffer:
+    """运动触发录制的预录环形缓冲，保存 (采集时间, JPEG 字节)。
+
+    同时受时长与总字节数限制，存放压缩后的 JPEG 而非原始 BGR 帧，
+    内存占用可控。
+    """
+
+    def __init__(self, seconds=5.0, max_bytes=32 * 1024 * 1024):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self._frames = deque()
+        self._bytes = 0
+
+    def add(self, capture_ts, jpeg):
+        self._frames.append((capture_ts, jpeg))
+        self._bytes += len(jpeg)
+        while self._frames and (capture_ts - self._frames[0][0] > self.seconds
+                                or self._bytes > self.max_bytes):
+            _, old = self._frames.popleft()
+            self._bytes -= len(old)
+
+    def drain(self):
+        frames = list(self._frames)
+        self._frames.clear()
+        self._bytes = 0
+        return frames
+
+
+class ChangeFilter:
+    """录制去重：与上次写入的帧比较，画面几乎没变的帧不落盘。
+
+    比较在 width 像素宽的灰度缩略图上进行（INTER_AREA 缩放本身起到降噪作用），
+    变化量为灰度差超过 pixel_delta 的像素所占百分比，低于 threshold 即跳过；
+    距上次写入超过 heartbeat 秒时无论是否变化都写入一帧，保证时间线连续。
+    """
+
+    def __init__(self, threshold=0.0, heartbeat=60.0, width=96, pixel_delta=16):
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.width = width
+        self.pixel_delta = pixel_delta
+        self._last = None
+        self._last_ts = 0.0
+
+    def reset(self):
+        self._last = None
+
+    def _signature(self, frame):
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.width, max(1, int(h * self.width / w))), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def check(self, frame, capture_ts):
+        # 返回 True 表示应当写入；关闭（threshold 为 0）时总是写入
+        if not self.threshold:
+            self._last = None
+            return True
+        sig = self._signature(frame)
+        if self._last is not None and self._last.shape == sig.shape \
+                and capture_ts - self._last_ts < self.heartbeat:
+            diff = cv2.absdiff(sig, self._last)
+            changed = cv2.countNonZero(cv2.threshold(diff, self.pixel_delta, 255, cv2.THRESH_BINARY)[1])
+            if changed * 100.0 / diff.size < self.threshold:
+                return False
+        self._last = sig
+        self._last_ts = capture_ts
+        return True
+
+
+class RecordingCatalog:
+    """录制目录的 SQLite 索引：每次录制一个会话，每个落盘的帧一条记录
+    （采集时间、文件名、分段内帧序号、字节数、是否有运动）。
+
+    写盘线程只把记录追加到内存列表，由索引线程按批提交事务；时间范围查询按
+    (ts, id) 索引做键集分页，帧数再多也只读取一页。数据库为 WAL 模式，查询
+    与写入互不阻塞。
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            started REAL,
+            ended REAL,
+            frames INTEGER NOT NULL DEFAULT 0,
+            motion_frames INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS sessions_started ON sessions(started);
+        CREATE TABLE IF NOT EXISTS frames (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            file TEXT NOT NULL,
+            offset INTEGER,
+            size INTEGER,
+            motion INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS frames_ts ON frames(ts, id);
+        CREATE INDEX IF NOT EXISTS frames_session_ts ON frames(session_id, ts, id);
+    '''
+
+    def __init__(self, root, path=None, flush_interval=1.0, batch_size=500, exclude=()):
+        self.root = root
+        self.path = path or os.path.join(root, 'catalog.db')
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._session_ids = {}
+        # 正在写入的会话由 add_frame 建索引，补录时跳过，避免重复
+        self._live = set(exclude)
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._indexed = 0
+        self._errors = 0
+        self._last_error = ''
+        # 启动补录完成后置位，保留清理等需要完整索引的任务先等待它
+        self.ready = threading.Event()
+        # 写连接只在索引线程中使用；保留清理另用一个维护连接，两者由 SQLite 写锁串行化
+        self._db = self._connect()
+        self._db.executescript(self.SCHEMA)
+        self._upgrade_schema()
+        self._maint_db = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _upgrade_schema(self):
+        # 旧版本的 frames.id 没有 AUTOINCREMENT，删除的编号会被新记录复用，而缩略图 URL 按编号长期缓存。
+        # 原样拷贝到新表：拷贝时最大编号记入 sqlite_sequence，之后不再复用
+        row = self._db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'frames'").fetchone()
+        if 'AUTOINCREMENT' in row[0].upper():
+            return
+        self._db.executescript(
+            'BEGIN;'
+            'ALTER TABLE frames RENAME TO frames_old;'
+            'DROP INDEX frames_ts;'
+            'DROP INDEX frames_session_ts;'
+            + self.SCHEMA +
+            'INSERT INTO frames SELECT * FROM frames_old;'
+            'DROP TABLE frames_old;'
+            'COMMIT;')
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _reader(self):
+        # 每个请求线程一个只读连接
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def add_frame(self, target_dir, capture_ts, path, offset=None, size=None, motion=False):
+        row = (os.path.basename(os.path.normpath(target_dir)), capture_ts, os.path.basename(path),
+               offset, size, int(bool(motion)))
+        with self._lock:
+            self._live.add(row[0])
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        # 启动时补录已存在但尚未建索引的录制目录，之后定期批量提交
+        try:
+            self.import_existing()
+        except Exception as e:
+            self._record_error(e)
+        self.ready.set()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _record_error(self, e):
+        with self._lock:
+            self._errors += 1
+            self._last_error = f"{type(e).__name__}: {e}"
+
+    def _session_id(self, name):
+        sid = self._session_ids.get(name)
+        if sid is None:
+            self._db.execute('INSERT OR IGNORE INTO sessions (name) VALUES (?)', (name,))
+            sid = self._db.execute('SELECT id FROM sessions WHERE name = ?', (name,)).fetchone()[0]
+            self._session_ids[name] = sid
+        return sid
+
+    def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if rows:
+            self._insert(rows)
+
+    def _insert(self, rows):
+        by_session = {}
+        for name, *frame in rows:
+            by_session.setdefault(name, []).append(frame)
+        try:
+            with self._db:
+                for name, frames in by_session.items():
+                    sid = self._session_id(name)
+                    self._db.executemany(
+                        'INSERT INTO frames (session_id, ts, file, offset, size, motion) VALUES (?, ?, ?, ?, ?, ?)',
+                        [(sid, *f) for f in frames])
+                    ts = [f[0] for f in frames]
+                    self._db.execute(
+                        'UPDATE sessions SET started = min(coalesce(started, ?), ?), ended = max(coalesce(ended, ?), ?),'
+                        ' frames = frames + ?, motion_frames = motion_frames + ?, bytes = bytes + ? WHERE id = ?',
+                        (min(ts), min(ts), max(ts), max(ts), len(frames), sum(f[4] for f in frames),
+                         sum(f[3] or 0 for f in frames), sid))
+        except Exception as e:
+            # 事务已回滚；会话编号缓存可能失效，清空后下次重新查询
+            self._session_ids.clear()
+            self._record_error(e)
+            return
+        with self._lock:
+            self._indexed += len(rows)
+
+    def _claim_session(self, name):
+        # 在同一个写事务中确认会话尚无记录并建立它：多个工作进程共用一个索引同时补录时，
+        # 只有先拿到 SQLite 写锁的进程导入该会话，其余进程看到记录已存在而跳过
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            if self._db.execute('SELECT 1 FROM sessions WHERE name = ?', (name,)).fetchone():
+                return False
+            self._session_id(name)
+        return True
+
+    def import_existing(self):
+        # 为索引建立之前就存在的录制目录补建记录：JPEG 时间取自文件名，视频帧取自 .idx
+        known = {r[0] for r in self._db.execute('SELECT name FROM sessions')}
+        for name in sorted(os.listdir(self.root)):
+            session_dir = os.path.join(self.root, name)
+            with self._lock:
+                live = name in self._live
+            if live or name in known or name.startswith('.') or not os.path.isdir(session_dir):
                 continue
-            motion_detected = True
-            (x, y, w, h) = cv2.boundingRect(c)
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            if not self._claim_session(name):
+                continue
+            rows = []
+            for file in sorted(os.listdir(session_dir)):
+                path = os.path.join(session_dir, file)
+                if file.startswith('img-') and file.endswith('.jpg'):
+                    try:
+                        ts = datetime.strptime(file[4:23], '%Y%m%d_%H%M%S_%f').timestamp()
+                        rows.append((name, ts, file, None, os.path.getsize(path), 0))
+                    except (ValueError, OSError):
+                        continue
+                elif file.startswith(('seg-', 'timelapse-')) and file.endswith('.idx'):
+                    video = segment_video_path(path)
+                    if video is None:
+                        continue
+                    video = os.path.basename(video)
+                    rows.extend((name, ts, video, index, None, 0) for index, ts in read_segment_index(path))
+            for i in range(0, len(rows), self.batch_size):
+                self._insert(rows[i:i + self.batch_size])
+
+    def sessions(self, limit=50, before=None):
+        # 按开始时间倒序；before 为上一页最后一个会话的开始时间
+        return [dict(r) for r in self._reader().execute(
+            'SELECT name, started, ended, frames, motion_frames, bytes FROM sessions'
+            ' WHERE started IS NOT NULL AND started < ? ORDER BY started DESC LIMIT ?',
+            (float('inf') if before is None else before, limit))]
 
-        # 前端负责播放声音和闪红边框，服务器端不再发声。
+    def frames(self, start=None, end=None, session=None, motion=None, after=None, limit=100):
+        # after 为上一页最后一帧的 (ts, id)，按 (ts, id) 键集分页
+        lower = float('-inf') if start is None else start
+        if after is not None:
+            # 同时收紧 ts 下界，让查询走索引区间而不是从头扫描
+            lower = max(lower, after[0])
+        where = ['f.ts >= ?', 'f.ts < ?']
+        args = [lower, float('inf') if end is None else end]
+        if after is not None:
+            where.append('(f.ts, f.id) > (?, ?)')
+            args.extend(after)
+        if session is not None:
+            where.append('f.session_id = (SELECT id FROM sessions WHERE name = ?)')
+            args.append(session)
+        if motion is not None:
+            where.append('f.motion = ?')
+            args.append(int(motion))
+        args.append(limit)
+        return [dict(r) for r in self._reader().execute(
+            'SELECT f.id, f.ts, s.name AS session, f.file, f.offset, f.size, f.motion'
+            ' FROM frames f JOIN sessions s ON s.id = f.session_id'
+            f' WHERE {" AND ".join(where)} ORDER BY f.ts, f.id LIMIT ?', args)]
 
-        prev_frame = gray.copy()
+    def frame(self, frame_id):
+        row = self._reader().execute(
+            'SELECT f.id, f.ts, s.name AS session, f.file, f.offset, f.size, f.motion'
+            ' FROM frames f JOIN sessions s ON s.id = f.session_id WHERE f.id = ?', (frame_id,)).fetchone()
+        return dict(row) if row else None
 
-        # 在输出帧左下角添加时间水印（camera_loop 保留水印绘制）
+    def thumbnail(self, frame_id, width=160):
+        # 缩略图缓存在 <root>/.thumbs 下，同一帧同一宽度只生成一次；帧不存在或读取失败返回 None
+        cache = os.path.join(self.root, '.thumbs', f'{frame_id}-{width}.jpg')
         try:
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            fh, fw = frame.shape[:2]
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            scale = 0.6
-            thickness = 2
-            x = 10
-            y = fh - 10
-            cv2.putText(frame, timestamp, (x, y), font, scale, (0, 0, 0), thickness + 2, cv2.LINE_AA)
-            cv2.putText(frame, timestamp, (x, y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
-        except Exception:
+            with open(cache, 'rb') as f:
+                return f.read()
+        except OSError:
             pass
-        with lock:
-            output_frame = frame.copy()
+        info = self.frame(frame_id)
+        if info is None:
+            return None
+        image = read_recorded_frame(os.path.join(self.root, info['session'], info['file']), info['offset'], width)
+        if image is None:
+            return None
+        h, w = image.shape[:2]
+        if w > width:
+            image = cv2.resize(image, (width, max(1, int(h * width / w))), interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 75])
+        if not ret:
+            return None
+        data = jpeg.tobytes()
+        # 先写临时文件再改名，并发请求不会读到半个文件
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = f'{cache}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, cache)
+        return data
 
-        time.sleep(0.03)
+    def _maintenance(self):
+        # 维护连接只在保留清理线程中使用
+        if self._maint_db is None:
+            self._maint_db = self._connect()
+        return self._maint_db
 
+    def session_times(self):
+        # 所有会话的 {名称: (开始, 结束)}，按帧的采集时间计
+        return {r[0]: (r[1], r[2]) for r in self._reader().execute('SELECT name, started, ended FROM sessions')}
 
-# ======================
-# 录制后台线程（每隔10秒保存一张图片）
-# ======================
-def recording_loop():
-    global recording_active, recording_dir
+    def session_frames(self, name):
+        # 一个会话的全部帧 [(ts, file, offset, motion), ...]，按时间排序
+        return [tuple(r) for r in self._reader().execute(
+            'SELECT f.ts, f.file, f.offset, f.motion FROM frames f'
+            ' WHERE f.session_id = (SELECT id FROM sessions WHERE name = ?) ORDER BY f.ts, f.id', (name,))]
+
+    def replace_session_frames(self, name, frames, size):
+        # 用压缩后的帧 [(ts, file, offset, motion), ...] 替换会话原有的帧记录，size 为会话目录的新大小
+        db = self._maintenance()
+        with db:
+            row = db.execute('SELECT id FROM sessions WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return
+            sid = row[0]
+            old_ids = [r[0] for r in db.execute('SELECT id FROM frames WHERE session_id = ?', (sid,))]
+            db.execute('DELETE FROM frames WHERE session_id = ?', (sid,))
+            db.executemany('INSERT INTO frames (session_id, ts, file, offset, size, motion) VALUES (?, ?, ?, ?, NULL, ?)',
+                           [(sid, *f) for f in frames])
+            db.execute('UPDATE sessions SET frames = ?, motion_frames = ?, bytes = ? WHERE id = ?',
+                       (len(frames), sum(f[3] for f in frames), size, sid))
+        self._drop_thumbnails(old_ids)
+
+    def remove_session(self, name):
+        db = self._maintenance()
+        with db:
+            row = db.execute('SELECT id FROM sessions WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return
+            old_ids = [r[0] for r in db.execute('SELECT id FROM frames WHERE session_id = ?', (row[0],))]
+            db.execute('DELETE FROM frames WHERE session_id = ?', (row[0],))
+            db.execute('DELETE FROM sessions WHERE id = ?', (row[0],))
+        self._session_ids.pop(name, None)
+        self._drop_thumbnails(old_ids)
+
+    def _drop_thumbnails(self, frame_ids):
+        # 删除已不存在的帧的缩略图缓存（帧编号不复用，旧缓存只是占空间）
+        frame_ids = {str(i) for i in frame_ids}
+        try:
+            entries = list(os.scandir(os.path.join(self.root, '.thumbs')))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.split('-', 1)[0] in frame_ids:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'indexed': self._indexed,
+                'pending': len(self._pending),
+                'errors': self._errors,
+                'last_error': self._last_error,
+            }
+
+
+def read_recorded_frame(path, offset=None, min_width=0):
+    # 读取一帧录像：offset 为 None 时 path 是 JPEG 文件，否则是视频分段中的帧序号。
+    # JPEG 尽量用 libjpeg 的 1/8、1/4、1/2 缩小解码，只要结果不窄于 min_width
+    if offset is None:
+        data = np.fromfile(path, dtype=np.uint8) if os.path.exists(path) else None
+        if data is None or not data.size:
+            return None
+        if min_width:
+            for flag in (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_COLOR_2):
+                image = cv2.imdecode(data, flag)
+                if image is None:
+                    return None
+                if image.shape[1] >= min_width:
+                    return image
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            return None
+        cap.set(cv2.CAP_PROP_POS_FRAMES, offset)
+        ret, image = cap.read()
+        return image if ret else None
+    finally:
+        cap.release()
+
+
+class PlaybackReader:
+    """按时间顺序读取一个会话中已录制帧的 JPEG 字节，供回放流原样发送。
+
+    JPEG 文件整个读出、不解码；视频分段以原始包模式（CAP_PROP_FORMAT=-1）读取，
+    MJPEG 分段的每个包本身就是一张完整的 JPEG。其它编码（mp4v）的分段退回
+    解码后重新编码。连续的帧复用同一个打开的分段，只有不连续时才 seek。
+    """
+
+    def __init__(self, session_dir, quality=80):
+        self.session_dir = session_dir
+        self.quality = quality
+        self._cap = None
+        self._file = None
+        self._pos = 0
+        self._raw = True
+
+    def _open(self, file, raw=True):
+        self.close()
+        self._cap = cv2.VideoCapture(os.path.join(self.session_dir, file))
+        self._raw = raw and bool(self._cap.set(cv2.CAP_PROP_FORMAT, -1))
+        self._file = file
+        self._pos = 0
+
+    def read(self, file, offset=None):
+        # 返回 (JPEG 字节, 来源)，来源为 'file'、'packet' 或 'reencode'；读取失败返回 (None, None)
+        if offset is None:
+            try:
+                with open(os.path.join(self.session_dir, file), 'rb') as f:
+                    return f.read(), 'file'
+            except OSError:
+                return None, None
+        if file != self._file:
+            self._open(file)
+        if offset != self._pos:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, offset)
+            self._pos = offset
+        ret, data = self._cap.read()
+        self._pos += 1
+        if ret and self._raw:
+            if data is not None and data.size > 2 and data.flat[0] == 0xFF and data.flat[1] == 0xD8:
+                return data.tobytes(), 'packet'
+            # 包不是 JPEG：该分段改为解码模式重新打开
+            self._open(file, raw=False)
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, offset)
+            ret, data = self._cap.read()
+            self._pos = offset + 1
+        if not ret or data is None:
+            return None, None
+        ret, jpeg = cv2.imencode('.jpg', data, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return (jpeg.tobytes(), 'reencode') if ret else (None, None)
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+            self._file = None
+
+
+def get_recording_catalog():
+    global recording_catalog
+    with recording_catalog_lock:
+        if recording_catalog is None:
+            live = [os.path.basename(cam.recording_dir) for cam in cameras.values() if cam.recording_dir]
+            recording_catalog = RecordingCatalog(recordings_root, exclude=live)
+        return recording_catalog
+
+
+class RetentionManager:
+    """录制目录的后台保留清理。
+
+    周期性扫描各会话目录：结束超过 max_age 的会话删除；结束超过 compact_after
+    的会话压缩成一个延时视频（每 timelapse_step 秒取一帧，优先取有运动的帧），
+    写好后删除原始文件；总占用仍超过 max_bytes 时从最早的会话开始删除。
+    正在录制或最近仍有写入的会话不动。线程以最低调度优先级运行，读写按 io_rate
+    限速，录制写盘队列积压时先让路；目录索引随之更新。
+    """
+
+    def __init__(self, root, interval=600.0):
+        self.root = root
+        self.interval = interval
+        self.max_bytes = retention_max_bytes
+        self.max_age = retention_max_age
+        self.compact_after = retention_compact_after
+        self.timelapse_step = retention_timelapse_step
+        self.timelapse_fps = retention_timelapse_fps
+        self.io_rate = retention_io_rate
+        # 最后一次写入距今不足该秒数的会话视为仍在使用
+        self.settle_seconds = 60.0
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._io_due = 0.0
+        self._runs = 0
+        self._last_run = 0.0
+        self._last_duration = 0.0
+        self._seconds_total = 0.0
+        self._reclaimed = 0
+        self._compacted = 0
+        self._evicted = 0
+        self._usage = 0
+        self._errors = 0
+        self._last_error = ''
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def trigger(self):
+        self._wakeup.set()
+
+    def _run(self):
+        # 先创建目录索引：新线程会继承创建者的优先级，索引线程不应被一起降级
+        get_recording_catalog()
+        try:
+            # 只降低本线程的调度优先级（Linux 上线程即任务），其它平台忽略
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not (self.max_bytes or self.max_age or self.compact_after):
+                continue
+            start = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                    self._last_error = f"{type(e).__name__}: {e}"
+            elapsed = time.monotonic() - start
+            metrics.inc('camera_retention_seconds_total', elapsed)
+            with self._lock:
+                self._runs += 1
+                self._last_run = time.time()
+                self._last_duration = elapsed
+                self._seconds_total += elapsed
+
+    def _throttle(self, nbytes):
+        # 录制写盘队列积压超过一半时暂停；再按 io_rate 为本次读写排期，超前则睡眠
+        writer = recording_writer
+        while writer is not None:
+            stats = writer.stats()
+            if stats['queue_depth'] * 2 <= stats['queue_size']:
+                break
+            time.sleep(0.1)
+        if not self.io_rate:
+            return
+        now = time.monotonic()
+        self._io_due = max(self._io_due, now) + nbytes / float(self.io_rate)
+        if self._io_due - now > 0.05:
+            time.sleep(self._io_due - now)
+
+    def _scan(self, catalog):
+        # 返回 {会话名: {'path', 'bytes', 'started', 'ended', 'modified', 'compacted', 'originals'}}
+        times = catalog.session_times()
+        live = {os.path.basename(os.path.normpath(cam.recording_dir))
+                for cam in cameras.values() if cam.recording_active and cam.recording_dir}
+        sessions = {}
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.compact-'):
+                # 上次压缩中途退出留下的临时目录
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            if entry.name.startswith('.') or entry.name in live or not entry.is_dir():
+                continue
+            # 最近写入时间取自文件（目录本身的修改时间会因压缩时增删文件而更新）
+            size, modified, compacted, originals = 0, 0.0, False, False
+            for f in os.scandir(entry.path):
+                st = f.stat()
+                size += st.st_size
+                modified = max(modified, st.st_mtime)
+                if f.name.startswith('timelapse-'):
+                    compacted = compacted or f.name.endswith('.idx')
+                else:
+                    originals = True
+            modified = modified or entry.stat().st_mtime
+            started, ended = times.get(entry.name, (None, None))
+            sessions[entry.name] = {
+                'path': entry.path,
+                'bytes': size,
+                'started': started if started is not None else modified,
+                'ended': ended if ended is not None else modified,
+                'modified': modified,
+                'compacted': compacted,
+                'originals': originals,
+            }
+        return sessions
 
+    def run_once(self):
+        catalog = get_recording_catalog()
+        catalog.ready.wait()
+        now = time.time()
+        sessions = self._scan(catalog)
+        for name in sorted(sessions, key=lambda n: sessions[n]['started']):
+            s = sessions[name]
+            if now - s['modified'] < self.settle_seconds:
+                continue
+            if self.max_age and now - s['ended'] > self.max_age:
+                self._evict(catalog, name, s)
+            elif s['compacted'] and s['originals']:
+                self._finish_compaction(catalog, name, s)
+            elif self.compact_after and now - s['ended'] > self.compact_after and not s['compacted']:
+                self._compact(catalog, name, s)
+        if self.max_bytes:
+            # 超出总占用上限：从最早的会话开始删除，直到回到预算以内
+            total = sum(s['bytes'] for s in sessions.values())
+            for name in sorted(sessions, key=lambda n: sessions[n]['started']):
+                if total <= self.max_bytes:
+                    break
+                s = sessions[name]
+                if s.get('evicted') or now - s['modified'] < self.settle_seconds:
+                    continue
+                total -= self._evict(catalog, name, s)
+        with self._lock:
+            self._usage = sum(s['bytes'] for s in sessions.values())
+        metrics.set('camera_recordings_bytes', self._usage)
+
+    def _reclaimed_bytes(self, nbytes, action):
+        with self._lock:
+            self._reclaimed += nbytes
+            if action == 'evicted':
+                self._evicted += 1
+            else:
+                self._compacted += 1
+        metrics.inc('camera_retention_reclaimed_bytes_total', nbytes)
+        metrics.inc('camera_retention_sessions_total', action=action)
+
+    def _delete_files(self, session_dir, keep=lambda name: False):
+        # 逐个删除文件并按元数据操作计入限速，返回释放的字节数
+        freed = 0
+        try:
+            entries = list(os.scandir(session_dir))
+        except OSError:
+            return 0
+        for entry in entries:
+            if keep(entry.name):
+                continue
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            freed += size
+            self._throttle(4096)
+        return freed
+
+    def _evict(self, catalog, name, s):
+        freed = self._delete_files(s['path'])
+        try:
+            os.rmdir(s['path'])
+        except OSError:
+            pass
+        catalog.remove_session(name)
+        s['bytes'] = 0
+        s['evicted'] = True
+        self._reclaimed_bytes(freed, 'evicted')
+        return freed
+
+    def _read_frames(self, session_dir, picks):
+        # 按时间顺序读取选中的帧：JPEG 整文件读入后解码，视频分段顺序 grab 跳过不需要的帧
+        cap, cap_file, pos, frame_bytes = None, None, 0, 0
+        try:
+            for ts, file, offset, motion in picks:
+                path = os.path.join(session_dir, file)
+                if offset is None:
+                    data = np.fromfile(path, dtype=np.uint8) if os.path.exists(path) else None
+                    if data is None or not data.size:
+                        continue
+                    self._throttle(data.size)
+                    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                else:
+                    if file != cap_file:
+                        if cap is not None:
+                            cap.release()
+                        cap, cap_file, pos = cv2.VideoCapture(path), file, 0
+                        count = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 1
+                        frame_bytes = os.path.getsize(path) / count if os.path.exists(path) else 0
+                    while pos < offset and cap.grab():
+                        pos += 1
+                        self._throttle(frame_bytes)
+                    ret, image = cap.read()
+                    pos += 1
+                    self._throttle(frame_bytes)
+                    if not ret:
+                        continue
+                if image is not None:
+                    yield ts, motion, image
+        finally:
+            if cap is not None:
+                cap.release()
+
+    def _compact(self, catalog, name, s):
+        rows = catalog.session_frames(name)
+        if not rows:
+            # 尚未建立索引的会话等下一轮
+            return 0
+        # 每 timelapse_step 秒一个时间桶，桶内优先取有运动的帧
+        picks = {}
+        for row in rows:
+            bucket = int((row[0] - rows[0][0]) // self.timelapse_step)
+            if bucket not in picks or (row[3] and not picks[bucket][3]):
+                picks[bucket] = row
+        picks = [picks[b] for b in sorted(picks)]
+
+        # 先在临时目录写好延时视频，再移入会话目录，最后才删除原始文件
+        tmp = os.path.join(self.root, '.compact-' + name)
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        writer = SegmentWriter(tmp, 'avi', float('inf'), self.timelapse_fps, prefix='timelapse')
+        frames = []
+        size = 0
+        try:
+            for ts, motion, image in self._read_frames(s['path'], picks):
+                path, index = writer.write(ts, image)
+                frames.append((ts, os.path.basename(path), index, motion))
+                # 写入同样计入限速：按延时视频文件本帧增长的字节数排期
+                grown = os.path.getsize(path) - size
+                size += grown
+                self._throttle(max(grown, 0))
+        finally:
+            writer.close()
+        if not frames:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return 0
+        written = 0
+        for f in os.listdir(tmp):
+            path = os.path.join(s['path'], f)
+            written += os.path.getsize(os.path.join(tmp, f))
+            os.replace(os.path.join(tmp, f), path)
+            # 修改时间保持为会话结束时间：压缩不算“最近写入”，也不推迟按时间的清理
+            os.utime(path, (s['ended'], s['ended']))
+        os.rmdir(tmp)
+        catalog.replace_session_frames(name, frames, written)
+        return self._remove_originals(name, s, written)
+
+    def _finish_compaction(self, catalog, name, s):
+        # 上次压缩在删除原始文件之前中断：按延时视频的索引重建帧记录，再删除原始文件
+        frames, written = [], 0
+        for f in sorted(os.listdir(s['path'])):
+            path = os.path.join(s['path'], f)
+            if not f.startswith('timelapse-'):
+                continue
+            written += os.path.getsize(path)
+            video = segment_video_path(path) if f.endswith('.idx') else None
+            if video is not None:
+                frames.extend((ts, os.path.basename(video), index, 0) for index, ts in read_segment_index(path))
+        catalog.replace_session_frames(name, frames, written)
+        return self._remove_originals(name, s, written)
+
+    def _remove_originals(self, name, s, written):
+        # 净回收量：删掉的原始文件减去新写入的延时视频
+        freed = max(0, self._delete_files(s['path'], keep=lambda f: f.startswith('timelapse-')) - written)
+        s['bytes'] = written
+        s['compacted'] = True
+        s['originals'] = False
+        self._reclaimed_bytes(freed, 'compacted')
+        return freed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'max_age': self.max_age,
+                'compact_after': self.compact_after,
+                'timelapse_step': self.timelapse_step,
+                'io_rate': self.io_rate,
+                'usage_bytes': self._usage,
+                'runs': self._runs,
+                'last_run': self._last_run,
+                'last_duration': round(self._last_duration, 3),
+                'seconds_total': round(self._seconds_total, 3),
+                'reclaimed_bytes': self._reclaimed,
+                'compacted': self._compacted,
+                'evicted': self._evicted,
+                'errors': self._errors,
+                'last_error': self._last_error,
+            }
+
+
+def get_retention_manager():
+    global retention_manager
+    with recording_catalog_lock:
+        if retention_manager is None:
+            retention_manager = RetentionManager(recordings_root)
+        return retention_manager
+
+
+def recording_loop(cam):
+    # 帧选择阶段：按间隔挑选帧并提交给写盘工作池，自身从不阻塞在磁盘 IO 上。
+    # 运动触发的启停依据运动起止时刻判断，两次保存之间开始又结束的运动也会触发录制
     last_saved = 0
+    last_seq = 0
+    segment_dir = None
+    pre_roll = PreRollBuffer(cam.pre_roll_seconds, pre_roll_max_bytes)
+    # 布防期间订阅按录制间隔限帧的码流配置，预录直接取其已编码的 JPEG，
+    # 每个间隔只编码一帧，与同帧率的观看者共享
+    profile = None
+    pre_roll_seq = 0
+    # 已处理过的最近一次运动开始时刻
+    handled_onset = 0.0
+    change_filter = ChangeFilter()
+    filter_dir = None
 
     while True:
-        # 等待一会儿或直到录制被触发（短超时以支持高频率保存）
-        recording_event.wait(timeout=0.01)
+        if not cam.recording_active and segment_dir:
+            # 停止录制时关闭当前分段，保证容器文件完整可播放
+            recording_writer.close_segment(segment_dir)
+            segment_dir = None
+        if profile is not None and cam.recording_trigger != 'motion':
+            # 撤防后不再需要预录，先退订码流再阻塞等待
+            profile.bus.remove_listener(cam.recording_wakeup.set)
+            release_stream_profile(cam, profile)
+            profile = None
+        # 未录制且未布防时阻塞等待录制被触发，不再定时轮询
+        cam.recording_event.wait()
+        cam.recording_wakeup.clear()
 
-        if not recording_active:
-            time.sleep(0.2)
+        with cam.recording_lock:
+            active = cam.recording_active
+            auto = cam.recording_auto
+            armed = cam.recording_trigger == 'motion'
+            interval = cam.recording_interval
+            target_dir = cam.recording_dir
+            mode = cam.recording_mode
+            fmt = cam.recording_video_format
+            segment_seconds = cam.recording_segment_seconds
+            pre_roll.seconds = cam.pre_roll_seconds
+            post_roll = cam.post_roll_seconds
+            change_filter.threshold = cam.recording_change_threshold
+            change_filter.heartbeat = cam.recording_heartbeat
+        if not active and not armed:
+            pre_roll.drain()
             continue
+        pre_roll_fps = min(30.0, 1.0 / interval)
+        if armed and (profile is None or profile.fps != pre_roll_fps):
+            if profile is None:
+                # 刚布防：之前已结束的运动不触发录制
+                handled_onset = cam.motion_started_ts
+            else:
+                # 录制间隔变了：换成新帧率的码流
+                profile.bus.remove_listener(cam.recording_wakeup.set)
+                release_stream_profile(cam, profile)
+            profile = acquire_stream_profile(cam, 0, pre_roll_fps, 0)
+            # 限帧码流每发布一帧唤醒本线程取走放入预录缓冲
+            profile.bus.add_listener(cam.recording_wakeup.set)
+            pre_roll_seq = 0
+        # 名义帧率取录制间隔对应的频率（上限 30），真实时间见分段索引
+        fps = min(30.0, max(1.0, 1.0 / interval))
+
+        if segment_dir and (mode != 'video' or segment_dir != target_dir):
+            # 从 video 切换到 jpeg 模式或换了会话目录：结束当前分段
+            recording_writer.close_segment(segment_dir)
+            segment_dir = None
 
-        # 取一帧并保存
-        with lock:
-            frame = None if output_frame is None else output_frame.copy()
+        # 下一次保存的时刻；开始/停止/修改间隔以及运动开始/结束都会提前唤醒
+        due = last_saved + interval
+        if armed:
+            motion = cam.motion_detected
+            onset = cam.motion_started_ts
+            now = time.time()
+            if not active and (motion or onset > handled_onset):
+                # 运动开始（包括已经结束的短暂运动）：以预录首帧时间新建会话，先写入预录帧
+                handled_onset = onset
+                frames = pre_roll.drain()
+                target_dir = new_recording_dir(cam, frames[0][0] if frames else onset or now)
+                with cam.recording_lock:
+                    cam.recording_dir = target_dir
+                    cam.recording_active = True
+                    cam.recording_auto = True
+                cam.event_hub.publish('recording', recording_state(cam))
+                for ts, jpeg in frames:
+                    recording_writer.submit(target_dir, ts, None, mode, fmt, segment_seconds, fps, jpeg=jpeg,
+                                            cam=cam)
+                if mode == 'video' and frames:
+                    segment_dir = target_dir
+                active = True
+                # 立即保存触发时的当前帧
+                due = 0
+            elif active:
+                handled_onset = onset
+                if auto:
+                    # 延录只作用于运动自动开始的会话，手动开始的会话直到 /stop_recording 才结束。
+                    # 最近一次有运动的时刻：运动仍在持续则为现在，否则为运动结束时刻
+                    last_motion_ts = now if motion else cam.motion_ended_ts
+                    if now - last_motion_ts >= post_roll:
+                        # 运动结束且延录时间已过：结束本次会话，回到布防状态
+                        with cam.recording_lock:
+                            cam.recording_active = False
+                            cam.recording_auto = False
+                        cam.event_hub.publish('recording', recording_state(cam))
+                        continue
+                    if not motion:
+                        # 延录到期时醒来结束会话
+                        due = min(due, last_motion_ts + post_roll)
 
-        if frame is None:
-            # 当帧不可用时短睡，避免长时间阻塞
-            time.sleep(0.01)
+        if not active:
+            # 布防待触发：取走限帧码流新发布的帧放入预录缓冲，然后等待下一帧或运动开始
+            seq, capture_ts, jpeg = profile.bus.latest()
+            if jpeg is not None and seq > pre_roll_seq:
+                pre_roll_seq = seq
+                pre_roll.add(capture_ts, jpeg)
+            cam.recording_wakeup.wait(1.0)
             continue
 
-        now_ts = time.time()
-        # 首次保存或者到达设置的间隔
-        with recording_lock:
-            interval = recording_interval
-        if last_saved == 0 or (now_ts - last_saved) >= interval:
+        remaining = due - time.time()
+        if remaining > 0:
+            cam.recording_wakeup.wait(remaining)
+            continue
+
+        # 等待一帧比上次保存更新的帧（帧已带采集时刻的时间水印）
+        got = cam.frame_bus.wait(last_seq, timeout=1.0)
+        if got is None:
+            continue
+        last_seq, capture_ts, frame, _ = got
+        last_saved = time.time()
+        motion = cam.motion_detected
+
+        if not target_dir:
+            continue
+        if target_dir != filter_dir:
+            # 新会话的第一帧总是写入
+            change_filter.reset()
+            filter_dir = target_dir
+        if not change_filter.check(frame, capture_ts):
+            cam.recording_frames_skipped += 1
+            metrics.inc('camera_recording_frames_total', camera=cam.id, result='skipped')
+            continue
+        if shm_name and cam.id == default_camera_id:
+            # 共享内存槽位会被采集进程循环覆盖，排队写盘的帧需要自己的拷贝；
+            # 拷贝期间槽位已被覆盖则丢弃这一帧
+            copied = np.array(frame)
+            if not frame_intact(frame):
+                metrics.inc('camera_torn_frames_total', stage='record')
+                continue
+            frame = copied
+        recording_writer.submit(target_dir, capture_ts, frame, mode, fmt, segment_seconds, fps, motion=motion, cam=cam)
+        if mode == 'video':
+            segment_dir = target_dir
+
+
+def ensure_recording_started(cam):
+    global recording_writer
+    with recording_writer_lock:
+        if recording_writer is None:
+            recording_writer = RecordingWriter(recording_writer_workers, recording_queue_size,
+                                               recording_queue_policy)
+    with cam.recording_thread_lock:
+        if not cam.recording_thread_started:
+            t = threading.Thread(target=recording_loop, args=(cam,), daemon=True)
+            t.start()
+            cam.recording_thread_started = True
+
+# ======================
+# ASGI 服务模式（asyncio）
+# ======================
+# 视频流与 SSE 以协程方式原生处理：等待新帧不占用线程，写套接字由 ASGI 服务器做流控
+# （send 在传输缓冲满时挂起）；其余路由交给 Flask，在有界线程池中执行。
+# 运行：python camera_web.py --asgi  或  uvicorn camera_web:asgi_app
+class AsyncBusWaiter:
+    """把 FrameBus 的发布通知桥接到 asyncio：每个码流配置每个事件循环只注册一个监听，
+    无论多少协程在等待，编码线程每帧只需一次 call_soon_threadsafe。"""
+
+    def __init__(self, bus, loop):
+        self.bus = bus
+        self.loop = loop
+        self.users = 0
+        self._event = asyncio.Event()
+        bus.add_listener(self._notify)
+
+    def _notify(self):
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _wake(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, after_seq=0, timeout=None):
+        # 与 FrameBus.wait 返回值一致；在事件循环线程中检查与取事件之间不会错过唤醒
+        while True:
+            seq, ts, item = self.bus.latest()
+            if seq > after_seq:
+                return seq, ts, item, (seq - after_seq - 1 if after_seq > 0 else 0)
             try:
-                tstr = time.strftime('%Y%m%d_%H%M%S', time.localtime(now_ts))
-                filename = f"img-{tstr}.jpg"
-                with recording_lock:
-                    target_dir = recording_dir
-                if target_dir:
-                    # 在保存前确保时间水印是最新的（在本地拷贝上绘制，避免修改共享的 output_frame）
-                    try:
-                        tstamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now_ts))
-                        fh, fw = frame.shape[:2]
-                        font = cv2.FONT_HERSHEY_SIMPLEX
-                        scale = 0.6
-                        thickness = 2
-                        x = 10
-                        y = fh - 10
-                        cv2.putText(frame, tstamp, (x, y), font, scale, (0, 0, 0), thickness + 2, cv2.LINE_AA)
-                        cv2.putText(frame, tstamp, (x, y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
-                    except Exception:
-                        pass
-                    path = os.path.join(target_dir, filename)
-                    cv2.imwrite(path, frame)
-                    last_saved = now_ts
-            except Exception:
-                pass
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    def close(self):
+        self.bus.remove_listener(self._notify)
+
 
-        # 根据设置的间隔调整短睡，避免忙循环同时支持高频率
+async_waiters = {}
+# Flask 路由在此线程池中执行，线程数固定，不随观看者数量增长
+wsgi_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='wsgi')
+
+
+def acquire_async_waiter(profile):
+    loop = asyncio.get_running_loop()
+    key = (id(profile), id(loop))
+    waiter = async_waiters.get(key)
+    if waiter is None or waiter.bus is not profile.bus:
+        waiter = async_waiters[key] = AsyncBusWaiter(profile.bus, loop)
+    waiter.users += 1
+    return key, waiter
+
+
+def release_async_waiter(key, waiter):
+    waiter.users -= 1
+    if waiter.users <= 0:
+        waiter.close()
+        if async_waiters.get(key) is waiter:
+            del async_waiters[key]
+
+
+async def asgi_send_json(send, status, data):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def asgi_watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def asgi_video_feed(cam, scope, receive, send):
+    params, error = parse_stream_params(dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))))
+    if error:
+        await asgi_send_json(send, 400, {'success': False, 'error': error})
+        return
+    loop = asyncio.get_running_loop()
+    # 打开摄像头可能阻塞，放到线程池里做
+    client = await loop.run_in_executor(wsgi_executor, register_client, cam)
+    profile = acquire_stream_profile(cam, *params)
+    key, waiter = acquire_async_waiter(profile)
+    meter = ClientMeter(client, (scope.get('client') or ('', 0))[0], profile.key, cam.id)
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(asgi_watch_disconnect(receive, disconnected))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame'),
+                                (b'cache-control', b'no-cache')]})
+        last_seq = 0
+        while not disconnected.is_set():
+            got = await waiter.wait(last_seq, timeout=1.0)
+            if got is None:
+                continue
+            last_seq, capture_ts, jpeg, skipped = got
+            meter.skipped(skipped)
+            # send 在传输缓冲满时挂起（服务器流控），期间的新帧不排队，醒来后只取最新帧
+            start = meter.begin()
+            await send({'type': 'http.response.body', 'body': stream_part(jpeg, capture_ts), 'more_body': True})
+            meter.sent(start, capture_ts)
+    finally:
+        meter.close()
+        watcher.cancel()
+        release_async_waiter(key, waiter)
+        release_stream_profile(cam, profile)
+        await loop.run_in_executor(wsgi_executor, unregister_client, cam, client)
+
+
+async def asgi_snapshot(cam, scope, receive, send):
+    # 与 /snapshot.jpg 的 Flask 实现一致，但长轮询在事件循环中等待，不占用线程池
+    args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    params, error = parse_snapshot_params(args)
+    if error:
+        await asgi_send_json(send, 400, {'success': False, 'error': error})
+        return
+    width, quality, after, timeout = params
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(wsgi_executor, ensure_camera_started, cam)
+    profile = acquire_stream_profile(cam, width, 0.0, quality)
+    key, waiter = acquire_async_waiter(profile)
+    try:
+        latest = profile.bus.latest()
+        wait_seq = snapshot_wait_seq(latest, after)
+        got = latest if wait_seq is None else await waiter.wait(wait_seq, timeout)
+    finally:
+        release_async_waiter(key, waiter)
+        release_stream_profile(cam, profile)
+        await loop.run_in_executor(wsgi_executor, release_camera_if_idle, cam)
+    if got is None:
+        if latest[2] is None:
+            metrics.inc('camera_snapshot_requests_total', status='503')
+            await asgi_send_json(send, 503, {'success': False, 'error': 'no frame available'})
+            return
+        got = latest
+    seq, capture_ts, jpeg = got[:3]
+    headers = snapshot_headers(profile, seq, capture_ts)
+    if_none_match = dict(scope.get('headers', [])).get(b'if-none-match', b'').decode('latin-1')
+    raw = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    if etag_matches(if_none_match, headers[0][1]) or seq == after:
+        metrics.inc('camera_snapshot_requests_total', status='304')
+        await send({'type': 'http.response.start', 'status': 304, 'headers': raw})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    metrics.inc('camera_snapshot_requests_total', status='200')
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': raw + [(b'content-type', b'image/jpeg'), (b'content-length', str(len(jpeg)).encode())]})
+    await send({'type': 'http.response.body', 'body': jpeg})
+
+
+async def asgi_events(cam, scope, receive, send):
+    loop = asyncio.get_running_loop()
+    events_queue = asyncio.Queue(maxsize=64)
+
+    def put(item):
+        # 队列满时丢弃最旧的事件，与线程版 EventHub 行为一致
+        if events_queue.full():
+            events_queue.get_nowait()
+        events_queue.put_nowait(item)
+
+    def callback(event, data):
         try:
-            sleep_time = max(0.001, min(0.05, interval / 2.0))
-        except Exception:
-            sleep_time = 0.01
-        time.sleep(sleep_time)
+            loop.call_soon_threadsafe(put, (event, data))
+        except RuntimeError:
+            pass
+
+    subscription = cam.event_hub.subscribe(callback)
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(asgi_watch_disconnect(receive, disconnected))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        initial = (sse_message('motion', {'motion': bool(cam.motion_detected)})
+                   + sse_message('recording', recording_state(cam)))
+        await send({'type': 'http.response.body', 'body': initial.encode(), 'more_body': True})
+        while not disconnected.is_set():
+            try:
+                event, data = await asyncio.wait_for(events_queue.get(), 15)
+                chunk = sse_message(event, data)
+            except asyncio.TimeoutError:
+                chunk = ": keepalive\n\n"
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    finally:
+        watcher.cancel()
+        cam.event_hub.unsubscribe(subscription)
 
 
-def ensure_recording_started():
-    global recording_thread_started
-    with recording_thread_lock:
-        if not recording_thread_started:
-            t = threading.Thread(target=recording_loop, daemon=True)
-            t.start()
-            recording_thread_started = True
+async def asgi_playback(session, scope, receive, send):
+    # 与 /playback 的 Flask 实现一致：每帧的索引查询与读文件在线程池中执行，
+    # 倍速等待在事件循环中进行，回放期间不长期占用线程池
+    params, error = parse_playback_params(dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))))
+    if error:
+        await asgi_send_json(send, 400, {'success': False, 'error': error})
+        return
+    start, skip, step, speed = params
+    loop = asyncio.get_running_loop()
+    catalog = await loop.run_in_executor(wsgi_executor, get_recording_catalog)
+    if not await loop.run_in_executor(wsgi_executor, playback_has_frames, catalog, session, start):
+        await asgi_send_json(send, 404, {'success': False, 'error': f'no recorded frames: {session}'})
+        return
+    reader = PlaybackReader(os.path.join(recordings_root, session))
+    frames = playback_frames(catalog, reader, session, start, skip, step)
+    pacer = PlaybackPacer(speed)
+    done = object()
+    metrics.inc('camera_playback_streams', 1)
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(asgi_watch_disconnect(receive, disconnected))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame'),
+                                (b'cache-control', b'no-cache')]})
+        while not disconnected.is_set():
+            got = await loop.run_in_executor(wsgi_executor, next, frames, done)
+            if got is done:
+                break
+            ts, jpeg, source = got
+            delay = pacer.delay(ts)
+            if delay:
+                await asyncio.sleep(delay)
+            metrics.inc('camera_playback_frames_total', source=source)
+            await send({'type': 'http.response.body', 'body': stream_part(jpeg, ts), 'more_body': True})
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        await loop.run_in_executor(wsgi_executor, frames.close)
+        await loop.run_in_executor(wsgi_executor, reader.close)
+        metrics.inc('camera_playback_streams', -1)
+
+
+async def asgi_wsgi_delegate(scope, receive, send):
+    # 最小的 WSGI 适配：在线程池中执行 Flask，并逐块转发响应体（支持流式响应）
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        return lambda data: None
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(wsgi_executor, app, environ, start_response)
+    iterator = iter(result)
+    done = object()
+    try:
+        started = False
+        while True:
+            chunk = await loop.run_in_executor(wsgi_executor, next, iterator, done)
+            if not started:
+                await send({'type': 'http.response.start', 'status': response['status'],
+                            'headers': response['headers']})
+                started = True
+            if chunk is done:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(wsgi_executor, result.close)
+
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    session = scope['path'][len('/playback/'):] if scope['path'].startswith('/playback/') else ''
+    if session and '/' not in session:
+        # 回放不属于某个摄像头，也在事件循环中原生处理
+        await asgi_playback(session, scope, receive, send)
+        return
+    route = asgi_route(scope['path'])
+    if route is None:
+        await asgi_wsgi_delegate(scope, receive, send)
+        return
+    handler, cam_id = route
+    cam = cameras.get(cam_id or default_camera_id)
+    if cam is None:
+        await asgi_send_json(send, 404, {'success': False, 'error': f'unknown camera: {cam_id}'})
+        return
+    await handler(cam, scope, receive, send)
+
+
+def asgi_route(path):
+    # 原生协程处理的路由：返回 (处理函数, 摄像头编号)，其余路由返回 None 交给 Flask
+    if path in ('/video_feed', '/events', '/snapshot.jpg'):
+        cam_id = None
+    elif path.startswith(('/video_feed/', '/events/')):
+        prefix, _, cam_id = path[1:].partition('/')
+        path = '/' + prefix
+    elif path.startswith('/snapshot/') and path.endswith('.jpg'):
+        path, cam_id = '/snapshot.jpg', path[len('/snapshot/'):-len('.jpg')]
+    else:
+        return None
+    if cam_id is not None and (not cam_id or '/' in cam_id):
+        # 与 Flask 的 <cam_id> 一样只匹配一段路径，其余交给 Flask 返回 404
+        return None
+    handler = {'/video_feed': asgi_video_feed, '/events': asgi_events, '/snapshot.jpg': asgi_snapshot}[path]
+    return handler, cam_id
+
 
 # ======================
 # 主程序
 # ======================
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Camera monitor web server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--source',
+                        help="摄像头 0 的帧源：设备号、视频文件/图片目录，或 'synthetic:?width=1280&height=720&fps=30'")
+    parser.add_argument('--camera', action='append', metavar='ID=SOURCE',
+                        help="添加一路摄像头，可重复，例如 --camera 0=0 --camera door=1；"
+                             "页面与接口地址为 /camera/<ID>、/video_feed/<ID>、/status/<ID> 等")
+    parser.add_argument('--shm', default=shm_name,
+                        help='共享内存帧环名称；与 --capture-process 一起使用时作为写入方，否则作为读取方')
+    parser.add_argument('--asgi', action='store_true',
+                        help='使用 asyncio（ASGI）服务模式，需要安装 uvicorn')
+    parser.add_argument('--capture-process', action='store_true',
+                        help='只运行采集+检测进程，把帧写入 --shm 指定的共享内存（不启动 Web 服务）')
+    parser.add_argument('--retention-max-gb', type=float, default=0,
+                        help='录制目录总占用上限（GB），超出时从最早的会话开始删除；0 表示不限制')
+    parser.add_argument('--retention-max-days', type=float, default=0,
+                        help='录制最长保留天数；0 表示不限制')
+    parser.add_argument('--retention-compact-days', type=float, default=0,
+                        help='结束超过该天数的会话压缩成延时视频并删除原始文件；0 表示不压缩')
+    args = parser.parse_args()
+    try:
+        if args.camera:
+            configure_cameras(parse_camera_specs(';'.join(args.camera)))
+        elif args.source:
+            configure_cameras([('0', args.source)])
+    except ValueError as e:
+        parser.error(str(e))
+    if args.capture_process and len(cameras) > 1:
+        parser.error('--capture-process supports a single camera')
+    if args.capture_process:
+        if not args.shm:
+            parser.error('--capture-process requires --shm')
+        # 采集进程自身不读取共享内存：清掉可能来自 CAMERA_SHM 的读取方设置，
+        # 否则默认摄像头会去连接自己尚未创建的帧环
+        shm_name = None
+        run_capture_process(args.shm)
+    else:
+        # 多进程部署示例（只用于观看：各工作进程的控制状态互不相通，默认摄像头的
+        # 录制控制与检测参数路由在工作进程中返回 409）：
+        #   python camera_web.py --capture-process --shm camera_web &
+        #   CAMERA_SHM=camera_web gunicorn -w 4 --threads 32 -b 0.0.0.0:5000 camera_web:app
+        shm_name = args.shm
+        retention_max_bytes = int(args.retention_max_gb * 1024 ** 3)
+        retention_max_age = args.retention_max_days * 86400
+        retention_compact_after = args.retention_compact_days * 86400
+        if retention_max_bytes or retention_max_age or retention_compact_after:
+            get_retention_manager().trigger()
+        if args.asgi:
+            try:
+                import uvicorn
+            except ImportError:
+                parser.error('--asgi requires uvicorn (pip install uvicorn)')
+            # 自己创建监听套接字：accept 得到的连接继承其发送缓冲大小（uvicorn 不暴露连接套接字）
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            limit_send_buffer(sock)
+            sock.bind((args.host, args.port))
+            server = uvicorn.Server(uvicorn.Config(asgi_app, log_level='warning'))
+            server.run(sockets=[sock])
+        else:
+            app.run(host=args.host, port=args.port, debug=False, threaded=True)